@@ -0,0 +1,276 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+"""Benchmarks of the scadl hot paths on synthetic AES traces.
+
+Usage: python -m benchmarks.run --scales small,medium --output results.jsonl
+
+Every result is printed and appended as one JSON line to --output, so the
+timings and peak memory can be tracked across versions.
+"""
+
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+from collections.abc import Callable
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from benchmarks.synthetic import synthetic_aes, synthetic_predictions
+from scadl.alignment import Aligner
+from scadl.augmentation import Mixup, RandomCrop
+from scadl.cpa import cpa
+from scadl.multi_task import compute_guessing_entropy, compute_rank
+from scadl.preprocessing import Scaler
+from scadl.profile import Match
+from scadl.tools import (
+    SboxLeakage,
+    gen_labels,
+    normalization,
+    remove_avg,
+    sbox,
+    standardize,
+)
+
+# name: (nb_traces, nb_samples)
+SCALES = {
+    "small": (1000, 700),
+    "medium": (10000, 700),
+    "large": (100000, 1400),
+}
+
+BENCHMARKS: dict[str, Callable] = {}
+
+
+def benchmark(name: str) -> Callable:
+    """Register a benchmark taking the Data of a scale"""
+
+    def register(func: Callable) -> Callable:
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+class Data:
+    """Synthetic traces, metadata and predictions of one scale"""
+
+    def __init__(self, nb_traces: int, nb_samples: int, noise: float, seed: int):
+        self.traces, self.metadata = synthetic_aes(
+            nb_traces, nb_samples, noise, seed=seed
+        )
+        self.predictions = synthetic_predictions(self.metadata, 0, noise, seed)
+        self.correct_key = int(self.metadata["key"][0][0])
+        self.labels = np.eye(256, dtype=np.float32)[SboxLeakage(0)(self.metadata)]
+        self.desync = desynchronized(self, 25)
+
+
+class PredictionModel:
+    """Stands for a trained model, so that Match.match times the rank only"""
+
+    def __init__(self, predictions: np.ndarray):
+        self.predictions = predictions
+
+    def predict(self, x: np.ndarray, **kwargs) -> np.ndarray:
+        return self.predictions[: len(x)]
+
+
+def scalar_leakage_model(data: np.ndarray, guess: int) -> int:
+    """Leakage model written like in the tutorials"""
+    return sbox[guess ^ int(data["plaintext"][0])]
+
+
+@benchmark("match")
+def bench_match(data: Data):
+    Match(PredictionModel(data.predictions), SboxLeakage(0)).match(
+        data.traces, data.metadata, 256, data.correct_key, step=10
+    )
+
+
+@benchmark("match_scalar_leakage_model")
+def bench_match_scalar(data: Data):
+    Match(PredictionModel(data.predictions), scalar_leakage_model).match(
+        data.traces, data.metadata, 256, data.correct_key, step=10
+    )
+
+
+@benchmark("compute_rank")
+def bench_compute_rank(data: Data):
+    compute_rank(
+        data.predictions, SboxLeakage(0), data.metadata, 256, data.correct_key, 10
+    )
+
+
+@benchmark("compute_guessing_entropy")
+def bench_guessing_entropy(data: Data):
+    compute_guessing_entropy(
+        data.predictions,
+        SboxLeakage(0),
+        data.metadata,
+        256,
+        data.correct_key,
+        step=10,
+        num_attacks=100,
+        seed=0,
+    )
+
+
+@benchmark("cpa")
+def bench_cpa(data: Data):
+    cpa(
+        data.traces,
+        data.metadata,
+        SboxLeakage(0, output="hw"),
+        256,
+        data.correct_key,
+        step=len(data.traces) // 10,
+    )
+
+
+def desynchronized(data: Data, max_shift: int) -> np.ndarray:
+    """The traces of :data: randomly shifted, as in ASCAD desync"""
+    shifts = np.random.default_rng(0).integers(0, max_shift + 1, len(data.traces))
+    return np.stack(
+        [np.roll(trace, shift) for trace, shift in zip(data.traces, shifts)]
+    )
+
+
+@benchmark("alignment_fft")
+def bench_alignment_fft(data: Data):
+    traces = data.desync
+    window = (traces.shape[1] // 4, traces.shape[1] // 2)
+    Aligner(window, max_shift=50).fit(traces).align(traces)
+
+
+@benchmark("alignment_dtw")
+def bench_alignment_dtw(data: Data):
+    traces = data.desync
+    window = (traces.shape[1] // 4, traces.shape[1] // 2)
+    Aligner(window, max_shift=50, method="dtw", band=8).fit(traces).align(traces)
+
+
+@benchmark("gen_labels")
+def bench_gen_labels(data: Data):
+    gen_labels(SboxLeakage(), data.metadata, key_byte=0)
+
+
+@benchmark("mixup")
+def bench_mixup(data: Data):
+    Mixup(0).generate(data.traces, data.labels, ratio=1)
+
+
+@benchmark("random_crop")
+def bench_random_crop(data: Data):
+    RandomCrop(0).generate(data.traces, data.labels, ratio=1, window=5)
+
+
+@benchmark("normalization")
+def bench_normalization(data: Data):
+    normalization(data.traces, feature_range=(-1, 1))
+
+
+@benchmark("standardize")
+def bench_standardize(data: Data):
+    standardize(data.traces)
+
+
+@benchmark("remove_avg")
+def bench_remove_avg(data: Data):
+    remove_avg(data.traces)
+
+
+@benchmark("scaler")
+def bench_scaler(data: Data):
+    Scaler("normalization", (-1, 1)).fit(data.traces).transform(data.traces)
+
+
+def measure(func: Callable, data: Data, repeat: int) -> tuple[float, int]:
+    """Best time of :repeat: runs, and peak memory traced on one more run"""
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(data)
+        seconds.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    func(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(seconds), peak
+
+
+def git_commit() -> Optional[str]:
+    """Commit of the scadl tree being benchmarked, if known"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=Path(__file__).parent,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", default="small,medium")
+    parser.add_argument("--benchmarks", default=",".join(BENCHMARKS))
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--noise", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path)
+    args = parser.parse_args()
+
+    context = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "machine": platform.machine(),
+    }
+    for scale in args.scales.split(","):
+        nb_traces, nb_samples = SCALES[scale]
+        data = Data(nb_traces, nb_samples, args.noise, args.seed)
+        for name in args.benchmarks.split(","):
+            seconds, peak = measure(BENCHMARKS[name], data, args.repeat)
+            result = {
+                "benchmark": name,
+                "scale": scale,
+                "nb_traces": nb_traces,
+                "nb_samples": nb_samples,
+                "seconds": seconds,
+                "traces_per_second": nb_traces / seconds,
+                "peak_memory_bytes": peak,
+                **context,
+            }
+            line = json.dumps(result)
+            print(line, flush=True)
+            if args.output is not None:
+                with open(args.output, "a", encoding="utf-8") as file:
+                    file.write(line + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from typing import Optional
+
+import numpy as np
+
+from scadl.tools import hw, sbox
+
+# Same layout as the ASCAD metadata
+METADATA_DTYPE = np.dtype(
+    [
+        ("plaintext", np.uint8, (16,)),
+        ("key", np.uint8, (16,)),
+        ("masks", np.uint8, (16,)),
+    ]
+)
+
+
+def synthetic_aes(
+    nb_traces: int,
+    nb_samples: int,
+    noise: float = 1.0,
+    key: Optional[np.ndarray] = None,
+    seed: Optional[int] = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Generate float32 traces leaking HW(sbox[p ^ k]) of the 16 bytes.
+
+    Byte i leaks at sample (i + 1) * nb_samples // 17, on top of Gaussian
+    noise of standard deviation :noise:. It returns (traces, metadata).
+    """
+    assert nb_samples >= 17
+    rng = np.random.default_rng(seed)
+    metadata = np.zeros(nb_traces, dtype=METADATA_DTYPE)
+    metadata["plaintext"] = rng.integers(0, 256, (nb_traces, 16))
+    metadata["key"] = rng.integers(0, 256, 16) if key is None else key
+    metadata["masks"] = rng.integers(0, 256, (nb_traces, 16))
+
+    traces = rng.normal(0, noise, (nb_traces, nb_samples)).astype(np.float32)
+    leakage = hw[sbox[metadata["plaintext"] ^ metadata["key"]]]
+    traces[:, (np.arange(16) + 1) * nb_samples // 17] += leakage
+    return traces, metadata
+
+
+def synthetic_predictions(
+    metadata: np.ndarray,
+    key_byte: int = 0,
+    noise: float = 1.0,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """Softmax outputs of an ideal HW model over the 256 sbox values.
+
+    Each trace is the posterior of a noisy HW(sbox[p ^ k]) observation, which
+    gives predictions with a realistic rank convergence.
+    """
+    rng = np.random.default_rng(seed)
+    value = sbox[metadata["plaintext"][:, key_byte] ^ metadata["key"][:, key_byte]]
+    observed = hw[value] + rng.normal(0, noise, len(metadata))
+    log_prob = -np.square(observed[:, np.newaxis] - hw) / (2 * noise**2)
+    prob = np.exp(log_prob - log_prob.max(axis=1, keepdims=True))
+    return (prob / prob.sum(axis=1, keepdims=True)).astype(np.float32)
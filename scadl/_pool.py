@@ -0,0 +1,53 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional
+
+import keras
+
+# State of a pool worker (NonProfile.attack_all, scadl.search), set once by
+# initialize
+worker: dict = {}
+
+
+def initialize(state: dict, threads: int, policy: Optional[str] = None):
+    """Pin the TF thread pools of the worker, set the keras dtype :policy:
+    (spawned workers start with the default one) and keep :state:, e.g. the
+    training data"""
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    if policy is not None:
+        keras.mixed_precision.set_global_policy(policy)
+    worker.update(state)
+
+
+def process_pool(
+    workers: int, state: dict, threads: int, policy: Optional[str] = None
+) -> ProcessPoolExecutor:
+    """Pool of :workers: spawned processes initialized with :state:, spawn
+    avoids forking an initialized TF runtime"""
+    return ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=initialize,
+        initargs=(state, threads, policy),
+    )
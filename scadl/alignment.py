@@ -0,0 +1,279 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from scadl.dataset import TraceDataset, read_traces
+
+# DTW directions of the cost matrix
+_DIAGONAL, _UP, _LEFT = 0, 1, 2
+
+
+def _fft_size(size: int) -> int:
+    """Smallest 2^a * 3^b * 5^c >= size, fast sizes of np.fft"""
+    best = 1 << (size - 1).bit_length()
+    power5 = 1
+    while power5 < best:
+        power35 = power5
+        while power35 < best:
+            power = power35
+            while power < size:
+                power *= 2
+            best = min(best, power)
+            power35 *= 3
+        power5 *= 5
+    return best
+
+
+def shift_traces(traces: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+    """Move every trace by its shift: aligned[n, t] = traces[n, t + shifts[n]],
+    the samples out of the trace are replaced by the first or last one"""
+    traces = np.asarray(traces)
+    positions = np.arange(traces.shape[1]) + np.asarray(shifts)[:, np.newaxis]
+    np.clip(positions, 0, traces.shape[1] - 1, out=positions)
+    return np.take_along_axis(traces, positions, axis=1)
+
+
+def _standardize(data: np.ndarray) -> np.ndarray:
+    """Zero mean and unit variance along the last axis"""
+    data = data - data.mean(axis=-1, keepdims=True)
+    return data / np.maximum(data.std(axis=-1, keepdims=True), 1e-12)
+
+
+def dtw_warp(traces: np.ndarray, reference: np.ndarray, band: int) -> np.ndarray:
+    """Elastic alignment of traces on :reference: (same length) by dynamic
+    time warping within a Sakoe-Chiba band of :band: samples.
+
+    The DTW is computed for all the traces at once, one reference sample at a
+    time. Sample i of the result is the mean of the trace samples matched to
+    the reference sample i.
+    """
+    traces = np.asarray(traces, dtype=np.float32)
+    count, width = traces.shape
+    span = 2 * band + 1
+    x = _standardize(traces)
+    r = _standardize(np.asarray(reference, dtype=np.float32))
+
+    # Band coordinates: reference sample i, trace sample j = i + k - band
+    offsets = np.arange(span) - band
+    directions = np.zeros((width, count, span), dtype=np.int8)
+    previous = np.full((count, span), np.inf, dtype=np.float32)
+    for i in range(width):
+        j = i + offsets
+        valid = (j >= 0) & (j < width)
+        cost = np.full((count, span), np.inf, dtype=np.float32)
+        cost[:, valid] = np.square(x[:, j[valid]] - r[i])
+
+        # (i - 1, j - 1) is at k, (i - 1, j) at k + 1 in the previous row
+        up = np.full((count, span), np.inf, dtype=np.float32)
+        up[:, :-1] = previous[:, 1:]
+        best = previous if i > 0 else np.full_like(previous, np.inf)
+        direction = np.where(up < best, _UP, _DIAGONAL).astype(np.int8)
+        best = np.minimum(best, up)
+        if i == 0:
+            best[:, band] = 0
+
+        # (i, j - 1) is at k - 1 in the current row
+        current = np.empty_like(cost)
+        current[:, 0] = cost[:, 0] + best[:, 0]
+        for k in range(1, span):
+            left = current[:, k - 1]
+            use_left = left < best[:, k]
+            direction[use_left, k] = _LEFT
+            current[:, k] = cost[:, k] + np.where(use_left, left, best[:, k])
+        directions[i] = direction
+        previous = current
+
+    # Backtrack all the paths from (width - 1, width - 1)
+    sums = np.zeros((count, width), dtype=np.float64)
+    counts = np.zeros((count, width), dtype=np.int64)
+    rows = np.arange(count)
+    i = np.full(count, width - 1)
+    k = np.full(count, band)
+    active = np.ones(count, dtype=bool)
+    while active.any():
+        n, ii, kk = rows[active], i[active], k[active]
+        jj = ii + kk - band
+        np.add.at(sums, (n, ii), traces[n, jj])
+        np.add.at(counts, (n, ii), 1)
+        direction = directions[ii, n, kk]
+        done = (ii == 0) & (jj == 0)
+        i[n] -= (direction != _LEFT) & ~done
+        k[n] += np.where(direction == _UP, 1, 0) - np.where(direction == _LEFT, 1, 0)
+        k[n] = np.where(done, kk, k[n])
+        active[n[done]] = False
+    return (sums / counts).astype(np.float32)
+
+
+class Aligner:
+    """Alignment of desynchronized traces on a reference pattern.
+
+    window: (start, stop) samples of the pattern, e.g. the start of the
+    targeted AES round.
+    max_shift: largest shift between two traces searched, in samples (twice
+    the desynchronization of ASCAD desync50 for instance).
+    method:
+    - "fft": every trace is shifted to maximize its normalized
+      cross-correlation with the reference, computed by FFT for a whole chunk
+      of traces at once,
+    - "dtw": the same shift, then the window is warped on the reference by
+      dynamic time warping in a band of :band: samples, for clock jitter.
+    The reference is computed by fit on the profiling traces and saved with
+    the model, so that the attack traces are aligned on the same pattern.
+    """
+
+    methods = ("fft", "dtw")
+
+    def __init__(
+        self,
+        window: tuple[int, int],
+        max_shift: int,
+        method: str = "fft",
+        band: int = 8,
+    ):
+        assert 0 <= window[0] < window[1]
+        assert max_shift >= 0 and band >= 0
+        assert method in self.methods
+        self.window = (int(window[0]), int(window[1]))
+        self.max_shift = int(max_shift)
+        self.method = method
+        self.band = int(band)
+        self.reference: Optional[np.ndarray] = None
+
+    def fit(
+        self,
+        traces: Union[np.ndarray, TraceDataset],
+        nb_traces: int = 1000,
+        iterations: int = 2,
+    ) -> "Aligner":
+        """Compute the reference: the window of the first trace, then the mean
+        window of the first :nb_traces: traces aligned on it, :iterations:
+        times"""
+        assert iterations >= 1
+        data = read_traces(traces, slice(0, nb_traces))
+        start, stop = self.window
+        assert stop <= data.shape[1]
+        self.reference = data[0, start:stop].astype(np.float32)
+        for _ in range(iterations):
+            aligned = shift_traces(data, self.shifts(data))
+            self.reference = aligned[:, start:stop].mean(axis=0, dtype=np.float32)
+        return self
+
+    def shifts(self, traces: np.ndarray) -> np.ndarray:
+        """Shift of every trace maximizing its normalized cross-correlation
+        with the reference, in [-max_shift, max_shift]"""
+        assert self.reference is not None
+        traces = np.asarray(traces, dtype=np.float32)
+        start, stop = self.window
+        width = stop - start
+        positions = np.arange(start - self.max_shift, stop + self.max_shift)
+        np.clip(positions, 0, traces.shape[1] - 1, out=positions)
+        segments = traces[:, positions].astype(np.float64)
+
+        # Cross-correlation of every segment with the zero-mean reference
+        reference = self.reference - self.reference.mean()
+        size = _fft_size(segments.shape[1] + width - 1)
+        spectrum = np.fft.rfft(segments, size, axis=1) * np.conj(
+            np.fft.rfft(reference, size)
+        )
+        correlation = np.fft.irfft(spectrum, size, axis=1)[:, : 2 * self.max_shift + 1]
+
+        # Norm of every zero-mean window of the segments, by cumulative sums
+        sums = np.cumsum(np.pad(segments, ((0, 0), (1, 0))), axis=1)
+        squares = np.cumsum(np.pad(np.square(segments), ((0, 0), (1, 0))), axis=1)
+        total = sums[:, width:] - sums[:, :-width]
+        energy = squares[:, width:] - squares[:, :-width] - np.square(total) / width
+        correlation /= np.sqrt(np.maximum(energy, 1e-12))
+        return (np.argmax(correlation, axis=1) - self.max_shift).astype(np.int32)
+
+    def apply(self, traces: np.ndarray, shifts: np.ndarray) -> np.ndarray:
+        """Align :traces: with known :shifts:, e.g. those returned by align
+        for other channels of the same executions"""
+        aligned = shift_traces(traces, shifts)
+        if self.method == "dtw":
+            start, stop = self.window
+            aligned = np.array(aligned, dtype=np.float32)
+            aligned[:, start:stop] = dtw_warp(
+                aligned[:, start:stop], self.reference, self.band
+            )
+        return aligned
+
+    def transform(self, traces: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Align a chunk of traces, return (aligned traces, shifts)"""
+        shifts = self.shifts(traces)
+        return self.apply(traces, shifts), shifts
+
+    def align(
+        self,
+        traces: Union[np.ndarray, TraceDataset],
+        chunk_size: int = 1000,
+        threads: Optional[int] = None,
+        out: Optional[np.ndarray] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Align all the traces chunk by chunk across a pool of :threads:.
+
+        traces may be a memory-mapped array or a TraceDataset, out an array
+        (e.g. a np.memmap) receiving the aligned traces. It returns the
+        aligned traces and the shifts of every trace.
+        """
+        chunks = [
+            slice(start, start + chunk_size)
+            for start in range(0, len(traces), chunk_size)
+        ]
+        shifts = np.zeros(len(traces), dtype=np.int32)
+
+        def run(index: slice):
+            aligned, shifts[index] = self.transform(read_traces(traces, index))
+            return aligned
+
+        with ThreadPoolExecutor(threads) as pool:
+            for index, aligned in zip(chunks, pool.map(run, chunks)):
+                if out is None:
+                    out = np.empty((len(traces),) + aligned.shape[1:], aligned.dtype)
+                out[index] = aligned
+        return out, shifts
+
+    def save(self, path: Union[str, Path]):
+        """Save the aligner and its reference as a .npz file"""
+        assert self.reference is not None
+        np.savez(
+            path,
+            window=self.window,
+            max_shift=self.max_shift,
+            method=self.method,
+            band=self.band,
+            reference=self.reference,
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "Aligner":
+        """Load an aligner saved with :save:"""
+        with np.load(path) as file:
+            aligner = cls(
+                tuple(file["window"]),
+                int(file["max_shift"]),
+                str(file["method"]),
+                int(file["band"]),
+            )
+            aligner.reference = file["reference"]
+        return aligner
@@ -15,34 +15,80 @@
 #
 #
 # Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+from collections.abc import Callable
+from typing import Optional
+
 import numpy as np
 
+# Number of augmented traces built at once, it bounds the temporaries
+BLOCK_TRACES = 4096
+
+
+def _float_dtype(data: np.ndarray) -> np.dtype:
+    """The input dtype if it is a float one, float32 otherwise"""
+    return np.result_type(data.dtype, np.float32)
+
+
+def _enlarge(
+    x_train: np.ndarray,
+    y_train: np.ndarray,
+    size: int,
+    augment: Callable[[int], tuple[np.ndarray, np.ndarray]],
+) -> tuple[np.ndarray, np.ndarray]:
+    """Return x_train, y_train followed by :size: augmented traces and labels.
+
+    The result is allocated once and the augmented part is filled block by
+    block with augment(block_size).
+    """
+    x = np.empty((len(x_train) + size,) + x_train.shape[1:], _float_dtype(x_train))
+    y = np.empty((len(y_train) + size,) + y_train.shape[1:], _float_dtype(y_train))
+    x[: len(x_train)] = x_train
+    y[: len(y_train)] = y_train
+    for start in range(len(x_train), len(x), BLOCK_TRACES):
+        stop = min(start + BLOCK_TRACES, len(x))
+        x[start:stop], y[start:stop] = augment(stop - start)
+    return x, y
+
 
 class Mixup:
     """This class used for data augmentation
     proposed in https://eprint.iacr.org/2021/328.pdf"""
 
+    def __init__(self, seed: Optional[int] = None):
+        self.rng = np.random.default_rng(seed)
+
+    def augment(
+        self, x_train: np.ndarray, y_train: np.ndarray, size: int, alpha: float = 0.2
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return :size: traces and labels mixing consecutive traces of x_train,
+        a single trace (e.g. the last batch of an epoch) is mixed with itself"""
+        last = x_train.shape[0] - 1
+        index = self.rng.integers(max(last, 1), size=size)
+        partner = np.minimum(index + 1, last)
+        lam = self.rng.beta(alpha, alpha, size=size)
+        # lam = np.clip(lam, 0.4, 0.6)
+
+        def mix(data: np.ndarray) -> np.ndarray:
+            weight = lam.astype(_float_dtype(data)).reshape(
+                (-1,) + (1,) * (data.ndim - 1)
+            )
+            mixed = data[index] * weight
+            mixed += data[partner] * (1 - weight)
+            return mixed
+
+        return mix(x_train), mix(y_train)
+
     def generate(
         self, x_train: np.ndarray, y_train: np.ndarray, ratio: float, alpha: float = 0.2
     ) -> tuple[np.ndarray, np.ndarray]:
         """It taked x_train, y_train, which are leakages and labels"""
 
         len_augmented_data = int(ratio * len(x_train))
-        augmented_data = np.zeros((len_augmented_data, x_train.shape[1]))
-        augmented_labels = np.zeros((len_augmented_data, y_train.shape[1]))
-        for i in range(len_augmented_data):
-            # lam = np.clip(np.random.beta(alpha, alpha), 0.4, 0.6)
-            lam = np.random.beta(alpha, alpha)
-            random_index = np.random.randint(x_train.shape[0] - 1)
-            augmented_data[i] = (lam * x_train[random_index]) + (
-                (1 - lam) * x_train[random_index + 1]
-            )
-            augmented_labels[i] = (lam * y_train[random_index]) + (
-                (1 - lam) * y_train[random_index + 1]
-            )
-
-        return np.concatenate((x_train, augmented_data), axis=0), np.concatenate(
-            (y_train, augmented_labels), axis=0
+        return _enlarge(
+            x_train,
+            y_train,
+            len_augmented_data,
+            lambda size: self.augment(x_train, y_train, size, alpha),
         )
 
 
@@ -50,22 +96,31 @@ class RandomCrop:
     """A data augmentation technique shown in
     https://blog.roboflow.com/why-and-how-to-implement-random-crop-data-augmentation/"""
 
+    def __init__(self, seed: Optional[int] = None):
+        self.rng = np.random.default_rng(seed)
+
+    def augment(
+        self, x_train: np.ndarray, y_train: np.ndarray, size: int, window: int
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Return :size: random traces of x_train with a random window set to 0"""
+        index = self.rng.integers(x_train.shape[0], size=size)
+        offset = self.rng.integers(x_train.shape[1] - window, size=size)
+        # Fancy indexing copies the traces, x_train is left untouched
+        augmented_data = x_train[index].astype(_float_dtype(x_train))
+        positions = offset[:, np.newaxis] + np.arange(window)
+        augmented_data[np.arange(size)[:, np.newaxis], positions] = 0
+        return augmented_data, y_train[index]
+
     def generate(
         self, x_train: np.ndarray, y_train: np.ndarray, ratio: float, window: int
     ) -> tuple[np.ndarray, np.ndarray]:
         """It taked x_train, y_train, ratio which are leakages, labels, and data increase ratio"""
         len_augmented_data = int(ratio * len(x_train))
-        augmented_data = np.zeros((len_augmented_data, x_train.shape[1]))
-        augmented_labels = np.zeros((len_augmented_data, y_train.shape[1]))
-        for i in range(len_augmented_data):
-            random_index = np.random.randint(x_train.shape[0])
-            sample_trace = x_train[random_index]
-            random_window = np.random.randint(x_train.shape[1] - window)
-            sample_trace[random_window : random_window + window] = 0
-            augmented_data[i] = sample_trace
-            augmented_labels[i] = y_train[random_index]
-        return np.concatenate((x_train, augmented_data), axis=0), np.concatenate(
-            (y_train, augmented_labels), axis=0
+        return _enlarge(
+            x_train,
+            y_train,
+            len_augmented_data,
+            lambda size: self.augment(x_train, y_train, size, window),
         )
 
 
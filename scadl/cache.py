@@ -0,0 +1,152 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+import hashlib
+import os
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from keras.models import Model
+
+from scadl.dataset import TraceDataset, TraceSequence, iter_chunks
+
+# Number of traces hashed at once by fingerprint
+CHUNK_TRACES = 10000
+
+
+def model_fingerprint(model: Model) -> str:
+    """Hash of the weights of :model:, it changes as soon as it is trained"""
+    digest = hashlib.blake2b(digest_size=16)
+    for weights in model.get_weights():
+        weights = np.ascontiguousarray(weights)
+        digest.update(f"{weights.dtype.str}{weights.shape}".encode())
+        digest.update(weights.data)
+    return digest.hexdigest()
+
+
+def traces_fingerprint(
+    traces: Union[np.ndarray, TraceDataset], chunk_size: int = CHUNK_TRACES
+) -> str:
+    """Hash of the traces fed to the model.
+
+    For a TraceDataset, the traces are hashed after the samples selection and
+    the transform, i.e. exactly as the model sees them. They are read chunk by
+    chunk, which is much cheaper than the inference it saves.
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk, _ in iter_chunks(traces, chunk_size=chunk_size):
+        chunk = np.ascontiguousarray(chunk)
+        digest.update(f"{chunk.dtype.str}{chunk.shape}".encode())
+        digest.update(chunk.data)
+    return digest.hexdigest()
+
+
+class PredictionCache:
+    """Softmax outputs of models stored on disk and memory-mapped on reuse.
+
+    The entries are keyed by the weights of the model and the traces, so
+    re-running the rank or guessing entropy with another step, number of
+    attacks or leakage model needs no inference. The least recently used
+    entries are removed once the cache is larger than :max_bytes:.
+    dtype: np.float16 halves the disk usage, the probabilities below ~6e-8
+    become 0. Match replaces them by the smallest probability of the trace
+    (see scadl.rank.zero_policy), pass zero="min" when calling
+    scadl.rank.key_rank on them directly.
+    """
+
+    def __init__(
+        self,
+        directory: Union[str, Path],
+        max_bytes: int = 1 << 32,
+        dtype: np.dtype = np.float32,
+    ):
+        assert np.dtype(dtype) in (np.float16, np.float32)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+
+    def key(self, model: Model, traces: Union[np.ndarray, TraceDataset]) -> str:
+        """Cache key of the predictions of :model: on :traces:"""
+        return (
+            f"{model_fingerprint(model)}-{traces_fingerprint(traces)}-{self.dtype.name}"
+        )
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{key}.npy"
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """Read-only memory map of the entry :key:, None if it is not cached"""
+        path = self._path(key)
+        try:
+            predictions = np.load(path, mmap_mode="r")
+        except FileNotFoundError:
+            return None
+        # The modification time orders the entries for the LRU eviction
+        os.utime(path)
+        return predictions
+
+    def put(self, key: str, predictions: np.ndarray) -> np.ndarray:
+        """Store :predictions: under :key: and return their memory map"""
+        path = self._path(key)
+        # Written aside and renamed, a reader never sees a partial file
+        temporary = path.with_suffix(f".{os.getpid()}.tmp")
+        with open(temporary, "wb") as file:
+            np.save(file, np.asarray(predictions, dtype=self.dtype))
+        os.replace(temporary, path)
+        self.evict(keep=path)
+        return np.load(path, mmap_mode="r")
+
+    def evict(self, keep: Optional[Path] = None):
+        """Remove the least recently used entries above max_bytes"""
+        entries = sorted(
+            (entry.stat().st_mtime, entry.stat().st_size, entry)
+            for entry in self.directory.glob("*.npy")
+        )
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in entries:
+            if total <= self.max_bytes:
+                break
+            if entry == keep:
+                continue
+            entry.unlink(missing_ok=True)
+            total -= size
+
+    def clear(self):
+        """Remove all the entries"""
+        for entry in self.directory.glob("*.npy"):
+            entry.unlink(missing_ok=True)
+
+    def predict(
+        self,
+        model: Model,
+        traces: Union[np.ndarray, TraceDataset],
+        batch_size: int = 100,
+    ) -> np.ndarray:
+        """model.predict(traces), computed only on a cache miss"""
+        key = self.key(model, traces)
+        predictions = self.get(key)
+        if predictions is not None:
+            return predictions
+        if isinstance(traces, TraceDataset):
+            predictions = model.predict(TraceSequence(traces, batch_size=batch_size))
+        else:
+            predictions = model.predict(traces, batch_size=batch_size)
+        return self.put(key, predictions)
@@ -0,0 +1,153 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from collections.abc import Callable, Sequence
+from typing import Optional, Union
+
+import numpy as np
+
+from scadl.dataset import TraceDataset, iter_chunks
+from scadl.rank import hypotheses, ranks
+
+
+class CPA:
+    """Streaming correlation power analysis of one or several key bytes.
+
+    leakage_models: one leakage model per byte, returning the predicted
+    leakage of every guess, e.g. SboxLeakage(key_byte=i, output="hw") for the
+    Hamming weight model or output="identity" for the sbox value.
+    The sums needed by the Pearson correlation are accumulated chunk by chunk,
+    with a single (traces x bytes*guesses)^T (traces x samples) product per
+    chunk for all the bytes and guesses.
+    """
+
+    def __init__(
+        self,
+        leakage_models: Union[Callable, Sequence[Callable]],
+        guess_range: int = 256,
+    ):
+        if callable(leakage_models):
+            leakage_models = [leakage_models]
+        self.leakage_models = list(leakage_models)
+        self.guess_range = guess_range
+        self.count = 0
+        self.sum_h = np.zeros(len(self.leakage_models) * guess_range)
+        self.sum_h2 = np.zeros_like(self.sum_h)
+        self.sum_t: Optional[np.ndarray] = None
+        self.sum_t2: Optional[np.ndarray] = None
+        self.sum_ht: Optional[np.ndarray] = None
+
+    def _hypotheses(self, metadata: np.ndarray) -> np.ndarray:
+        """(N, bytes * guesses) predicted leakages"""
+        return np.concatenate(
+            [
+                hypotheses(leakage_model, metadata, self.guess_range)
+                for leakage_model in self.leakage_models
+            ],
+            axis=1,
+        ).astype(np.float64)
+
+    def partial_fit(self, traces: np.ndarray, metadata: np.ndarray) -> "CPA":
+        """Update the sums with a chunk of traces and their metadata"""
+        traces = np.asarray(traces, dtype=np.float64)
+        assert len(traces) == len(metadata)
+        if self.sum_t is None:
+            self.sum_t = np.zeros(traces.shape[1])
+            self.sum_t2 = np.zeros(traces.shape[1])
+            self.sum_ht = np.zeros((len(self.sum_h), traces.shape[1]))
+        if len(traces) == 0:
+            return self
+
+        leakages = self._hypotheses(metadata)
+        self.count += len(traces)
+        self.sum_h += leakages.sum(axis=0)
+        self.sum_h2 += np.square(leakages).sum(axis=0)
+        self.sum_t += traces.sum(axis=0)
+        self.sum_t2 += np.square(traces).sum(axis=0)
+        self.sum_ht += leakages.T @ traces
+        return self
+
+    def fit(
+        self,
+        traces: Union[np.ndarray, TraceDataset],
+        metadata: Optional[np.ndarray] = None,
+        chunk_size: int = 10000,
+    ) -> "CPA":
+        """Accumulate the sums over :traces: chunk by chunk (see
+        scadl.dataset.iter_chunks)"""
+        for traces_chunk, metadata_chunk in iter_chunks(traces, metadata, chunk_size):
+            self.partial_fit(traces_chunk, metadata_chunk)
+        return self
+
+    def correlation(self) -> np.ndarray:
+        """Pearson correlation, shape (bytes, guesses, samples).
+
+        Constant guesses or samples have a null correlation.
+        """
+        assert self.count > 0
+        mean_h = self.sum_h / self.count
+        mean_t = self.sum_t / self.count
+        covariance = self.sum_ht / self.count - np.outer(mean_h, mean_t)
+        var_h = self.sum_h2 / self.count - mean_h**2
+        var_t = self.sum_t2 / self.count - mean_t**2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            corr = covariance / np.sqrt(np.outer(var_h, var_t))
+        corr = np.nan_to_num(corr, nan=0.0, posinf=0.0, neginf=0.0)
+        return corr.reshape(len(self.leakage_models), self.guess_range, -1)
+
+    def scores(self) -> np.ndarray:
+        """Max absolute correlation over the samples, shape (bytes, guesses)"""
+        return np.abs(self.correlation()).max(axis=2)
+
+    def best_guesses(self) -> np.ndarray:
+        """Guess with the highest score for every byte"""
+        return np.argmax(self.scores(), axis=1)
+
+
+def cpa(
+    traces: Union[np.ndarray, TraceDataset],
+    metadata: Optional[np.ndarray],
+    leakage_models: Union[Callable, Sequence[Callable]],
+    guess_range: int,
+    correct_keys: Union[int, Sequence[int]],
+    step: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Rank of the correct key every :step: traces, as returned by Match.match.
+
+    With a single leakage model and correct key, rank has shape (chunks,),
+    with a sequence of them (bytes, chunks) like MatchMultiLabel.match_all.
+    Every point needs the full correlation, so a larger step is faster.
+    """
+    single = callable(leakage_models)
+    if single:
+        correct_keys = [correct_keys]
+    engine = CPA(leakage_models, guess_range)
+    assert len(correct_keys) == len(engine.leakage_models)
+    assert step >= 1
+
+    rank = []
+    for traces_chunk, metadata_chunk in iter_chunks(traces, metadata, step):
+        scores = engine.partial_fit(traces_chunk, metadata_chunk).scores()
+        rank.append([ranks(s, k) for s, k in zip(scores, correct_keys)])
+
+    rank = np.array(rank, dtype=np.uint32).T
+    x_rank = (np.arange(rank.shape[1], dtype=np.uint32) + 1) * step
+    if single:
+        return rank[0], x_rank
+    return rank, x_rank
@@ -0,0 +1,219 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+import math
+from collections.abc import Callable, Iterator
+from pathlib import Path
+from typing import Optional, Union
+
+import h5py
+import keras
+import numpy as np
+
+Index = Union[int, slice, np.ndarray]
+
+# keras >= 3 renamed Sequence to PyDataset
+_PyDataset = getattr(keras.utils, "PyDataset", keras.utils.Sequence)
+
+
+def _read(array, index: Index) -> np.ndarray:
+    """Read :index: rows of an in-memory, memory-mapped or h5py array.
+
+    h5py only accepts increasing indices without duplicates, so index
+    arrays are read in sorted order and put back in the requested order.
+    """
+    if isinstance(index, np.ndarray):
+        rows, inverse = np.unique(index, return_inverse=True)
+        return np.asarray(array[rows])[inverse]
+    return np.asarray(array[index])
+
+
+class TraceDataset:
+    """Traces and their metadata, read from disk only when they are accessed.
+
+    traces: any array supporting slicing, e.g. np.ndarray, np.memmap or
+    h5py.Dataset.
+    samples: optional slice or index array of the samples (POIs) to keep.
+    transform: optional function applied to every batch of traces read, e.g.
+    the transform of a fitted scadl.preprocessing.Scaler.
+    """
+
+    def __init__(
+        self,
+        traces,
+        metadata,
+        samples: Optional[Union[slice, np.ndarray]] = None,
+        transform: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+    ):
+        assert len(traces) == len(metadata)
+        self.traces = traces
+        self.metadata = metadata
+        self.samples = samples
+        self.transform = transform
+
+    @classmethod
+    def from_hdf5(
+        cls,
+        path: Union[str, Path],
+        group: str = "Profiling_traces",
+        samples: Optional[Union[slice, np.ndarray]] = None,
+    ) -> "TraceDataset":
+        """Open an ASCAD-like group holding "traces" and "metadata" datasets"""
+        file = h5py.File(path, "r")
+        return cls(file[group]["traces"], file[group]["metadata"], samples)
+
+    @classmethod
+    def from_numpy(
+        cls,
+        traces_path: Union[str, Path],
+        metadata_path: Union[str, Path],
+        samples: Optional[Union[slice, np.ndarray]] = None,
+    ) -> "TraceDataset":
+        """Memory-map .npy files such as the CW traces.npy/combined_*.npy"""
+        return cls(
+            np.load(traces_path, mmap_mode="r"),
+            np.load(metadata_path, mmap_mode="r"),
+            samples,
+        )
+
+    def __len__(self) -> int:
+        return len(self.traces)
+
+    @property
+    def nb_samples(self) -> int:
+        """Number of samples per trace after the samples selection"""
+        if self.samples is None:
+            return self.traces.shape[1]
+        return len(np.arange(self.traces.shape[1])[self.samples])
+
+    def read_traces(self, index: Index) -> np.ndarray:
+        """Read the traces of :index: with the samples selection and the
+        transform applied"""
+        if isinstance(self.samples, slice) and not isinstance(index, np.ndarray):
+            traces = np.asarray(self.traces[index, self.samples])
+        else:
+            traces = _read(self.traces, index)
+            if self.samples is not None:
+                traces = traces[..., self.samples]
+        if self.transform is not None:
+            traces = self.transform(traces)
+        return traces
+
+    def read_metadata(self, index: Index) -> np.ndarray:
+        """Read the metadata of :index:"""
+        return _read(self.metadata, index)
+
+    def __getitem__(self, index: Index) -> tuple[np.ndarray, np.ndarray]:
+        return self.read_traces(index), self.read_metadata(index)
+
+    def batches(self, batch_size: int) -> Iterator[tuple[np.ndarray, np.ndarray]]:
+        """Iterate over (traces, metadata) batches in order"""
+        return iter_chunks(self, chunk_size=batch_size)
+
+
+Traces = Union[np.ndarray, TraceDataset]
+
+
+def read_traces(traces: Traces, index: Index) -> np.ndarray:
+    """Read the :index: rows of a np.ndarray, a memory-mapped or h5py array,
+    or of a TraceDataset with its samples selection and transform"""
+    if isinstance(traces, TraceDataset):
+        return traces.read_traces(index)
+    return _read(traces, index)
+
+
+def iter_chunks(
+    traces: Traces,
+    metadata: Optional[np.ndarray] = None,
+    chunk_size: int = 10000,
+    minimum: int = 1,
+) -> Iterator[tuple[np.ndarray, Optional[np.ndarray]]]:
+    """Iterate over (traces, metadata) chunks of :chunk_size: rows in order.
+
+    traces is read with read_traces. metadata may be any array of per-trace
+    values (e.g. labels), by default the metadata of a TraceDataset or None
+    for an array. The last chunk is merged with the previous one if it is
+    shorter than :minimum:.
+    """
+    if len(traces) == 0:
+        return
+    stops = list(range(chunk_size, len(traces), chunk_size)) + [len(traces)]
+    if len(stops) > 1 and stops[-1] - stops[-2] < minimum:
+        del stops[-2]
+    for start, stop in zip([0] + stops[:-1], stops):
+        index = slice(start, stop)
+        if metadata is not None:
+            yield read_traces(traces, index), _read(metadata, index)
+        elif isinstance(traces, TraceDataset):
+            yield traces[index]
+        else:
+            yield read_traces(traces, index), None
+
+
+class TraceSequence(_PyDataset):
+    """Keras generator streaming batches of a TraceDataset.
+
+    labels: maps a metadata batch to the targets of the batch, e.g. the one-hot
+    encoding of the leakage model. Without it, only the traces are returned
+    (for predict).
+    indices: the traces to use, all of them by default. It allows to split
+    the training and validation sets without copying the traces.
+    augmentation: optional function (x, y) -> (x, y) applied to every batch,
+    e.g. Mixup or RandomCrop generate, instead of enlarging the whole dataset.
+    """
+
+    def __init__(
+        self,
+        dataset: TraceDataset,
+        labels: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        batch_size: int = 100,
+        indices: Optional[np.ndarray] = None,
+        shuffle: bool = False,
+        augmentation: Optional[
+            Callable[[np.ndarray, np.ndarray], tuple[np.ndarray, np.ndarray]]
+        ] = None,
+        **kwargs,
+    ):
+        super().__init__(**kwargs)
+        self.augmentation = augmentation
+        self.dataset = dataset
+        self.labels = labels
+        self.batch_size = batch_size
+        self.indices = np.arange(len(dataset)) if indices is None else np.array(indices)
+        self.shuffle = shuffle
+        if shuffle:
+            np.random.shuffle(self.indices)
+
+    def __len__(self) -> int:
+        return math.ceil(len(self.indices) / self.batch_size)
+
+    def __getitem__(self, index: int):
+        batch = self.indices[index * self.batch_size : (index + 1) * self.batch_size]
+        # Sorted indices make contiguous reads on disk
+        x, metadata = self.dataset[np.sort(batch)]
+        if self.labels is None:
+            return x
+        y = self.labels(metadata)
+        if self.augmentation is not None:
+            return self.augmentation(x, y)
+        return x, y
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.indices)
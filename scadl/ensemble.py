@@ -0,0 +1,145 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+import math
+from collections.abc import Callable, Sequence
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Union
+
+import numpy as np
+from keras.models import Model
+
+from scadl.dataset import TraceDataset, iter_chunks
+from scadl.rank import hypotheses, log_likelihoods, ranks
+
+
+def score_ranks(scores: np.ndarray) -> np.ndarray:
+    """Rank of every guess along the last axis of :scores: (the number of
+    guesses scoring strictly higher), as scadl.rank.ranks for all guesses"""
+    ascending = np.sort(scores, axis=-1)
+    positions = np.empty(scores.shape, dtype=np.int64)
+    for row in np.ndindex(scores.shape[:-1]):
+        positions[row] = scores.shape[-1] - np.searchsorted(
+            ascending[row], scores[row], side="right"
+        )
+    return positions
+
+
+class EnsembleMatch:
+    """Attack with an ensemble of profiling models, e.g. trained with other
+    seeds, architectures or POI windows.
+
+    All the models predict the same batches of attack traces and the
+    log-likelihoods of the guesses are summed per chunk of traces right away,
+    so only the (models x chunks x guesses) scores are kept. aggregation:
+    - "sum": the log-likelihoods of the models are added (product of the
+      probabilities),
+    - "weighted": the same with one weight per model,
+    - "rank": the models rank the guesses separately after every chunk and
+      the guesses are ordered by the sum of their ranks (Borda count).
+    """
+
+    aggregations = ("sum", "weighted", "rank")
+
+    def __init__(
+        self,
+        models: Sequence[Model],
+        leakage_model: Callable,
+        aggregation: str = "sum",
+        weights: Optional[Sequence[float]] = None,
+        threads: bool = False,
+    ):
+        """threads: run the inference of every model in its own thread"""
+        assert len(models) > 0
+        assert aggregation in self.aggregations
+        assert (aggregation == "weighted") == (weights is not None)
+        assert weights is None or len(weights) == len(models)
+        self.models = list(models)
+        self.leakage_model = leakage_model
+        self.aggregation = aggregation
+        self.weights = None if weights is None else np.asarray(weights, np.float64)
+        self.threads = threads
+
+    def scores(
+        self,
+        x_test: Union[np.ndarray, TraceDataset],
+        metadata: Optional[np.ndarray],
+        guess_range: int,
+        step: int,
+        batch_size: int = 100,
+    ) -> np.ndarray:
+        """(models, chunks, guess_range) cumulative log-likelihoods of the
+        guesses of every model after every chunk of :step: traces.
+
+        x_test may be a TraceDataset streamed from disk, then metadata is None.
+        """
+        if isinstance(x_test, TraceDataset):
+            metadata = x_test.metadata
+        assert len(x_test) > 0 and len(x_test) == len(metadata)
+        assert step >= 1
+
+        sums = np.zeros((len(self.models), math.ceil(len(x_test) / step), guess_range))
+        pool = ThreadPoolExecutor(len(self.models)) if self.threads else None
+        try:
+            start = 0
+            for x, batch_metadata in iter_chunks(x_test, metadata, batch_size):
+                if pool is None:
+                    predictions = [model.predict_on_batch(x) for model in self.models]
+                else:
+                    predictions = list(
+                        pool.map(lambda model: model.predict_on_batch(x), self.models)
+                    )
+
+                # The indices of the guesses are shared by all the models
+                indices = hypotheses(self.leakage_model, batch_metadata, guess_range)
+                chunks = np.arange(start, start + len(indices)) // step
+                start += len(indices)
+                first = np.flatnonzero(np.diff(chunks, prepend=-1))
+                for m, prediction in enumerate(predictions):
+                    sums[m, chunks[first]] += np.add.reduceat(
+                        log_likelihoods(np.asarray(prediction), indices), first
+                    )
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return np.cumsum(sums, axis=1)
+
+    def match(
+        self,
+        x_test: Union[np.ndarray, TraceDataset],
+        metadata: Optional[np.ndarray],
+        guess_range: int,
+        correct_key: int,
+        step: int,
+        batch_size: int = 100,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Rank of the correct key every :step: traces, as Match.match"""
+        assert correct_key < guess_range
+        scores = self.scores(x_test, metadata, guess_range, step, batch_size)
+
+        if self.aggregation == "rank":
+            # The lower the sum of the ranks, the better the guess
+            rank = ranks(-sum(score_ranks(score) for score in scores), correct_key)
+        elif self.weights is None:
+            rank = ranks(scores.sum(axis=0), correct_key)
+        else:
+            rank = ranks(np.tensordot(self.weights, scores, axes=1), correct_key)
+
+        x_rank = (np.arange(len(rank), dtype=np.uint32) + 1) * step
+        return rank, x_rank
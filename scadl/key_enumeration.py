@@ -0,0 +1,115 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+import heapq
+from collections.abc import Callable, Iterator, Sequence
+
+import numpy as np
+
+from scadl.rank import log_likelihood_matrix
+
+
+def log_likelihood_table(
+    predictions: Sequence[np.ndarray],
+    leakage_models: Sequence[Callable],
+    metadata: np.ndarray,
+    guess_range: int = 256,
+) -> np.ndarray:
+    """Return the (bytes x guess_range) table of summed log-likelihoods.
+
+    predictions: one (N, classes) array per byte, e.g. the outputs of a
+    multi-task model, with the leakage model of each byte.
+    """
+    assert len(predictions) == len(leakage_models)
+    return np.stack(
+        [
+            log_likelihood_matrix(pred, leakage_model, metadata, guess_range).sum(
+                axis=0
+            )
+            for pred, leakage_model in zip(predictions, leakage_models)
+        ]
+    )
+
+
+def rank_estimation(
+    log_likelihoods: np.ndarray, correct_key: Sequence[int], nb_bins: int = 2048
+) -> tuple[float, float, float]:
+    """Estimate the rank of the full key by histogram convolution.
+
+    log_likelihoods: (bytes x guesses) table of scores, the higher the better.
+    It returns (lower, estimate, upper): bounds and estimate of the number of
+    keys scoring higher than :correct_key:, i.e. the remaining brute-force
+    effort. Use np.log2 to get it in bits.
+
+    Ref: https://eprint.iacr.org/2014/920.pdf
+    """
+    log_likelihoods = np.asarray(log_likelihoods, dtype=np.float64)
+    nb_bytes = len(log_likelihoods)
+    assert len(correct_key) == nb_bytes
+
+    low = log_likelihoods.min(axis=1, keepdims=True)
+    width = np.ptp(log_likelihoods, axis=1).max() / nb_bins
+    if width == 0:
+        width = 1.0
+    bins = np.minimum(((log_likelihoods - low) / width).astype(np.int64), nb_bins - 1)
+
+    histogram = np.ones(1)
+    for byte_bins in bins:
+        histogram = np.convolve(histogram, np.bincount(byte_bins, minlength=nb_bins))
+    correct = int(bins[np.arange(nb_bytes), correct_key].sum())
+
+    # Each byte score is off by less than one bin
+    lower = histogram[min(correct + nb_bytes + 1, len(histogram)) :].sum()
+    estimate = histogram[correct + 1 :].sum() + (histogram[correct] - 1) / 2
+    upper = histogram[max(correct - nb_bytes + 1, 0) :].sum() - 1
+    return float(lower), float(max(estimate, 0)), float(upper)
+
+
+def enumerate_keys(
+    log_likelihoods: np.ndarray, budget: int = 1 << 20
+) -> Iterator[tuple[np.ndarray, float]]:
+    """Yield (key, score) candidates in decreasing score order, lazily.
+
+    At most :budget: keys are yielded. The order is optimal: a key is only
+    yielded when no better one is left. The memory grows with the number of
+    keys yielded times the number of bytes.
+    """
+    log_likelihoods = np.asarray(log_likelihoods, dtype=np.float64)
+    nb_bytes = len(log_likelihoods)
+    order = np.argsort(-log_likelihoods, axis=1)
+    sorted_scores = np.take_along_axis(log_likelihoods, order, axis=1)
+    rows = np.arange(nb_bytes)
+
+    # Each state (an index in every sorted list) has a single parent, obtained
+    # by decrementing its last non-null index, so every key is pushed once.
+    start = (0,) * nb_bytes
+    heap = [(-float(sorted_scores[:, 0].sum()), start)]
+    for _ in range(budget):
+        if not heap:
+            return
+        negative_score, state = heapq.heappop(heap)
+        yield order[rows, state].astype(np.uint8), -negative_score
+
+        last = max((i for i, index in enumerate(state) if index), default=0)
+        for i in range(last, nb_bytes):
+            if state[i] + 1 < sorted_scores.shape[1]:
+                child = state[:i] + (state[i] + 1,) + state[i + 1 :]
+                # The child loses the difference between the two scores of byte i
+                loss = sorted_scores[i, state[i]] - sorted_scores[i, state[i] + 1]
+                heapq.heappush(heap, (negative_score + loss, child))
@@ -0,0 +1,283 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from collections.abc import Callable
+from typing import Optional, Union
+
+import numpy as np
+
+from scadl.rank import broadcasts, scalar_hypotheses
+
+# Largest lookup table built, in entries (inputs x guesses)
+MAX_ENTRIES = 1 << 24
+
+# Number of random metadata records used to detect the inputs and to check
+# the table
+PROBES = 8
+CHECKS = 64
+
+Input = tuple[str, int]
+
+
+class CompiledLeakageModel:
+    """Lookup table of a scalar leakage model over its byte-valued inputs.
+
+    inputs: the (field, byte) of the metadata the model depends on, the table
+    has one axis of 256 values per input, plus one axis of guess_range guesses
+    if the model takes a guess. It is vectorized (see
+    scadl.tools.vectorized): model(metadata, guesses) is a single gather.
+    """
+
+    vectorized = True
+
+    def __init__(
+        self,
+        leakage_model: Callable,
+        inputs: list[Input],
+        table: np.ndarray,
+        guess_range: Optional[int],
+    ):
+        self.leakage_model = leakage_model
+        self.inputs = inputs
+        self.table = table
+        self.guess_range = guess_range
+
+    def _columns(self, metadata: np.ndarray) -> tuple[np.ndarray, ...]:
+        metadata = np.asarray(metadata)
+        return tuple(
+            metadata[name].reshape(len(metadata), -1)[:, byte].astype(np.intp)
+            for name, byte in self.inputs
+        )
+
+    def __call__(
+        self, metadata: np.ndarray, guess: Optional[Union[int, np.ndarray]] = None
+    ) -> np.ndarray:
+        columns = self._columns(metadata)
+        if self.guess_range is None:
+            assert guess is None
+            return self.table[columns]
+        assert guess is not None
+        if np.ndim(guess) == 1:
+            # One column per guess
+            columns = tuple(column[:, np.newaxis] for column in columns)
+            return self.table[columns + (np.asarray(guess)[np.newaxis, :],)]
+        return self.table[columns + (guess,)]
+
+
+def _byte_inputs(metadata: np.ndarray) -> list[Input]:
+    """All the (field, byte) of the metadata holding bytes"""
+    names = metadata.dtype.names or ()
+    return [
+        (name, byte)
+        for name in names
+        if metadata.dtype[name].base == np.uint8
+        for byte in range(metadata[name].reshape(len(metadata), -1).shape[1])
+    ]
+
+
+class _Prober:
+    """Calls the scalar leakage model on modified copies of a record"""
+
+    def __init__(
+        self, leakage_model: Callable, metadata: np.ndarray, guess_range: Optional[int]
+    ):
+        self.leakage_model = leakage_model
+        self.guesses = None if guess_range is None else np.arange(guess_range)
+        self.record = metadata[:1].copy()
+        self.broadcast = self.guesses is not None and broadcasts(
+            leakage_model, self.record[0], self.guesses
+        )
+
+    def set(self, base: np.ndarray, values: dict[Input, int]):
+        self.record[...] = base
+        for (name, byte), value in values.items():
+            self.record[name][0].flat[byte] = value
+
+    def __call__(self) -> np.ndarray:
+        data = self.record[0]
+        if self.guesses is None:
+            return np.asarray(self.leakage_model(data))
+        if self.broadcast:
+            return np.asarray(self.leakage_model(data, self.guesses))
+        return np.array([self.leakage_model(data, g) for g in self.guesses])
+
+
+def compile_leakage_model(
+    leakage_model: Callable,
+    metadata: np.ndarray,
+    guess_range: Optional[int] = 256,
+    seed: Optional[int] = 0,
+    max_calls: Optional[int] = None,
+) -> Optional[CompiledLeakageModel]:
+    """Tabulate a scalar leakage model, e.g. sbox[guess ^ data["plaintext"][2]].
+
+    metadata: a structured array of records like those passed to the model.
+    guess_range: the model is called as leakage_model(data, guess) for the
+    guesses of range(guess_range), or as leakage_model(data) if None (the
+    profiling labels).
+    max_calls: largest number of model calls spent filling the table, e.g.
+    the calls of the scalar path on :metadata:.
+    The bytes the model depends on are found by changing them one at a time
+    on random records. The table is then filled and checked against the
+    scalar model on random records. It returns None when the model cannot be
+    tabulated: it depends on non-byte fields, too many bytes, it does not
+    broadcast over an array of guesses, the table costs more than :max_calls:
+    or the check fails.
+    """
+    metadata = np.asarray(metadata)
+    if metadata.dtype.names is None or len(metadata) == 0:
+        return None
+    rng = np.random.default_rng(seed)
+    try:
+        prober = _Prober(leakage_model, metadata, guess_range)
+        if guess_range is not None and not prober.broadcast:
+            # One call per table entry and guess, rarely worth it
+            return None
+
+        # Inputs changing the output on at least one probe
+        inputs = []
+        bases = metadata[rng.integers(0, len(metadata), PROBES)]
+        candidates = _byte_inputs(metadata)
+        for base in bases:
+            prober.set(base, {})
+            reference = prober()
+            for candidate in candidates:
+                if candidate in inputs:
+                    continue
+                prober.set(base, {candidate: int(rng.integers(0, 256))})
+                if not np.array_equal(prober(), reference):
+                    inputs.append(candidate)
+
+        nb_guesses = 1 if guess_range is None else guess_range
+        if 256 ** len(inputs) * nb_guesses > MAX_ENTRIES:
+            return None
+        if max_calls is not None and 256 ** len(inputs) > max_calls:
+            return None
+
+        # Fill the table, all the other fields taken from the first record
+        rows = []
+        for values in np.ndindex(*(256,) * len(inputs)):
+            prober.set(metadata[0], dict(zip(inputs, values)))
+            rows.append(prober())
+        table = np.array(rows).reshape((256,) * len(inputs) + np.shape(rows[0]))
+        if np.issubdtype(table.dtype, np.integer) and table.min(initial=0) >= 0:
+            table = table.astype(np.min_scalar_type(table.max(initial=0)))
+        compiled = CompiledLeakageModel(leakage_model, inputs, table, guess_range)
+
+        # Check the table against the scalar model on random records
+        samples = metadata[rng.integers(0, len(metadata), CHECKS)]
+        if guess_range is None:
+            expected = np.array([leakage_model(data) for data in samples])
+            actual = compiled(samples)
+        else:
+            guesses = np.arange(guess_range)
+            expected = np.array(
+                [[leakage_model(data, guess) for guess in guesses] for data in samples]
+            )
+            actual = compiled(samples, guesses)
+        if expected.shape != actual.shape or not np.array_equal(expected, actual):
+            return None
+    except (TypeError, ValueError, IndexError, KeyError):
+        return None
+    return compiled
+
+
+class TabulatedLeakageModel:
+    """Scalar leakage model tabulated on first use, see :tabulated:.
+
+    It is vectorized: model(metadata) gives the labels and model(metadata,
+    guesses) the (N, G) hypotheses, both with a single gather once the table
+    of the metadata layout is built. Models which cannot be tabulated, calls
+    with keyword arguments and single records use the scalar model.
+    """
+
+    vectorized = True
+
+    def __init__(self, leakage_model: Callable, guess_range: int = 256):
+        self.leakage_model = leakage_model
+        self.guess_range = guess_range
+        # (dtype, record shape, with guesses): compiled model
+        self.tables: dict = {}
+        # Same key: largest metadata on which the table was not built
+        self.failed: dict = {}
+
+    def table(
+        self, metadata: np.ndarray, guesses: bool
+    ) -> Optional[CompiledLeakageModel]:
+        """Compiled model of the layout of :metadata:, built if it costs fewer
+        calls than the scalar path on :metadata:"""
+        key = (metadata.dtype, metadata.shape[1:], guesses)
+        if key not in self.tables and len(metadata) > self.failed.get(key, 0):
+            table = compile_leakage_model(
+                self.leakage_model,
+                metadata,
+                self.guess_range if guesses else None,
+                max_calls=len(metadata),
+            )
+            if table is None:
+                self.failed[key] = len(metadata)
+            else:
+                self.tables[key] = table
+        return self.tables.get(key)
+
+    def _scalar(self, metadata: np.ndarray, guess, **kwargs) -> np.ndarray:
+        if np.ndim(guess) == 1 and not kwargs:
+            return scalar_hypotheses(self.leakage_model, metadata, np.asarray(guess))
+        if np.ndim(guess) == 1:
+            return np.array(
+                [[self.leakage_model(m, g, **kwargs) for g in guess] for m in metadata]
+            )
+        args = () if guess is None else (guess,)
+        return np.array([self.leakage_model(m, *args, **kwargs) for m in metadata])
+
+    def __call__(
+        self,
+        metadata: np.ndarray,
+        guess: Optional[Union[int, np.ndarray]] = None,
+        **kwargs,
+    ) -> np.ndarray:
+        metadata = np.asarray(metadata)
+        if metadata.ndim == 0:
+            args = () if guess is None else (guess,)
+            return self.leakage_model(metadata[()], *args, **kwargs)
+        table = None
+        if not kwargs and (
+            guess is None or np.all(np.asarray(guess) < self.guess_range)
+        ):
+            table = self.table(metadata, guess is not None)
+        if table is None:
+            return self._scalar(metadata, guess, **kwargs)
+        return table(metadata, guess)
+
+
+def tabulated(
+    leakage_model: Optional[Callable] = None, guess_range: int = 256
+) -> Union[TabulatedLeakageModel, Callable]:
+    """Tabulate the scalar :leakage_model: over the metadata bytes it depends
+    on, as @tabulated or @tabulated(guess_range=...).
+
+    Only use it on pure functions of the record and the guess: the tables
+    are built once per metadata layout and reused, so a model reading a
+    global variable would not see it change. The table is only built when
+    the model broadcasts over an array of guesses (or takes no guess) and
+    when it costs fewer calls than the scalar path.
+    """
+    if leakage_model is None:
+        return lambda model: TabulatedLeakageModel(model, guess_range)
+    return TabulatedLeakageModel(leakage_model, guess_range)
@@ -17,18 +17,33 @@
 # Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
 
 
-from collections.abc import Callable
+from collections.abc import Callable, Sequence
+from typing import Optional, Union
 
 import numpy as np
 from keras.models import Model
 
+from scadl.dataset import TraceDataset, TraceSequence
+from scadl.pipeline import make_dataset, multi_hot, split_indices
+from scadl.precision import Precision
+from scadl.rank import (
+    BLOCK_TRACES,
+    chunk_scores,
+    hypotheses,
+    key_rank,
+    log_likelihoods,
+)
+
 
 class MultiLabelProfile:
     """This class is used for multi-label classification"""
 
-    def __init__(self, model: Model):
+    def __init__(self, model: Model, precision: Optional[Precision] = None):
+        """precision: optional scadl.precision.Precision of the training
+        traces"""
         super().__init__()
         self.model = model
+        self.precision = precision
         self.history = None
 
     def train(
@@ -38,12 +53,72 @@ class MultiLabelProfile:
         epochs: int = 300,
         batch_size: int = 100,
         validation_split: float = 0.1,
+        pipeline: bool = False,
+        num_classes: Optional[int] = None,
         **kwargs,
     ):
         """This function accepts
         x_train: np.array,
         y_train: np.array,
+        pipeline: feed the model with a tf.data pipeline (see
+        scadl.pipeline.make_dataset) which splits by index and prefetches
+        the batches, instead of copying the arrays.
+        num_classes: if given, y_train holds the (N, bytes) integer labels,
+        e.g. np.stack([sbox_0, sbox_1], axis=1) as uint8, instead of the
+        multi-hot matrix. The multi-hot rows (bytes x num_classes columns, as
+        MultiLabelBinarizer gives for the labels l0, 256 + l1, ...) are then
+        built batch by batch.
         """
+        if self.precision is not None:
+            x_train = self.precision.store(x_train)
+        train_indices, validation_indices = split_indices(
+            len(x_train), validation_split
+        )
+        if pipeline:
+            self.history = self.model.fit(
+                make_dataset(
+                    x_train,
+                    y_train,
+                    train_indices,
+                    batch_size,
+                    num_classes,
+                    shuffle=True,
+                ),
+                epochs=epochs,
+                validation_data=(
+                    None
+                    if validation_indices is None
+                    else make_dataset(
+                        x_train, y_train, validation_indices, batch_size, num_classes
+                    )
+                ),
+                **kwargs,
+            )
+            return
+
+        if num_classes is not None:
+            # The integer labels are read as the metadata of the traces
+            dataset = TraceDataset(x_train, y_train)
+
+            def batch_labels(y: np.ndarray) -> np.ndarray:
+                return multi_hot(y, num_classes)
+
+            self.history = self.model.fit(
+                TraceSequence(
+                    dataset, batch_labels, batch_size, train_indices, shuffle=True
+                ),
+                epochs=epochs,
+                validation_data=(
+                    None
+                    if validation_indices is None
+                    else TraceSequence(
+                        dataset, batch_labels, batch_size, validation_indices
+                    )
+                ),
+                **kwargs,
+            )
+            return
+
         self.history = self.model.fit(
             x_train,
             y_train,
@@ -61,7 +136,9 @@ class MultiLabelProfile:
 class MatchMultiLabel:
     """This class is used for testing the attack"""
 
-    def __init__(self, model: Model, leakage_model: Callable):
+    def __init__(self, model: Model, leakage_model: Optional[Callable] = None):
+        """leakage_model: the model of the byte attacked by match, match_all
+        takes its own"""
         super().__init__()
         self.model = model
         self.leakage_model = leakage_model
@@ -74,32 +151,93 @@ class MatchMultiLabel:
         correct_key: int,
         step: int,
         prob_range: tuple[int, int] = (0, 256),
+        predictions: Optional[np.ndarray] = None,
     ) -> tuple[np.ndarray, np.ndarray]:
         """
         x_test, metadata: data used for profiling.
         prob_range depending on the targeted byte
         for ex: k0: (0, 256), k1: (256, 512), k2: (512, 768), .... etc
+        predictions: full model outputs on x_test computed beforehand (e.g.
+        with scadl.cache.PredictionCache), no inference is run then.
+        """
+        if predictions is None:
+            predictions = self.model.predict(x_test)
+
+        return key_rank(
+            predictions[:, prob_range[0] : prob_range[1]],
+            self.leakage_model,
+            metadata,
+            guess_range,
+            correct_key,
+            step,
+            log=np.log,
+        )
+
+    def match_all(
+        self,
+        x_test: np.ndarray,
+        metadata: np.ndarray,
+        guess_range: int,
+        correct_keys: Sequence[int],
+        step: int,
+        leakage_models: Union[Callable, Sequence[Callable]],
+        prob_ranges: Optional[Sequence[tuple[int, int]]] = None,
+        predictions: Optional[np.ndarray] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Attack several key bytes with a single inference.
+
+        leakage_models: one vectorized leakage model of all the attacked bytes,
+        whose hypotheses have shape (N, bytes, G), e.g.
+        SboxLeakage(key_byte=[0, 1]), or one leakage model per attacked byte.
+        prob_ranges: the output window of each byte, by default (0, 256),
+        (256, 512), ... like in match.
+        predictions: model outputs on x_test computed beforehand, as in match.
+        The hypotheses and log-likelihoods of all the bytes are computed in one
+        pass over the traces, block by block as in scadl.rank.key_rank.
+        It returns the (bytes x chunks) rank matrix and x_rank.
         """
-        predictions = self.model.predict(x_test)[:, prob_range[0] : prob_range[1]]
-
-        chunk_starts = range(0, len(x_test), step)
-        rank = np.zeros(len(chunk_starts), dtype=np.uint32)
-        x_rank = np.zeros(len(chunk_starts), dtype=np.uint32)
-        number_traces = 0
-        rank_array = np.zeros(guess_range)
-        for i, chunk_start in enumerate(chunk_starts):
-            pred_chunk = predictions[chunk_start : chunk_start + step]
-            metadata_chunk = metadata[chunk_start : chunk_start + step]
-            for row in range(len(pred_chunk)):
-                for guess in range(guess_range):
-                    index = self.leakage_model(metadata_chunk[row], guess)
-                    if pred_chunk[row, index] != 0:
-                        rank_array[guess] += np.log(pred_chunk[row, index])
-            rank[i] = np.where(sorted(rank_array)[::-1] == rank_array[correct_key])[0][
-                0
-            ]
-
-            number_traces += step
-            x_rank[i] = number_traces
+        count = len(correct_keys)
+        if prob_ranges is None:
+            prob_ranges = [(i * 256, (i + 1) * 256) for i in range(count)]
+        assert len(prob_ranges) == count
+        assert all(stop - start == guess_range for start, stop in prob_ranges)
+        assert max(correct_keys) < guess_range
+        assert step >= 1
+
+        def byte_hypotheses(data: np.ndarray) -> np.ndarray:
+            """(len(data), bytes, G) leakage model indices"""
+            if callable(leakage_models):
+                return hypotheses(leakage_models, data, guess_range)
+            assert len(leakage_models) == count
+            return np.stack(
+                [hypotheses(model, data, guess_range) for model in leakage_models],
+                axis=1,
+            )
+
+        if predictions is None:
+            predictions = self.model.predict(x_test)
+        assert len(predictions) > 0 and len(predictions) == len(metadata)
+
+        # Column of every byte and guess in the model outputs
+        offsets = np.array([start for start, _ in prob_ranges])[:, np.newaxis]
+        block = max(step, BLOCK_TRACES // count // step * step)
+        rank = []
+        total = np.zeros((count, guess_range))
+        for start in range(0, len(predictions), block):
+            indices = byte_hypotheses(metadata[start : start + block])
+            assert indices.shape[1:] == (count, guess_range)
+            scores = total + chunk_scores(
+                log_likelihoods(
+                    predictions[start : start + block],
+                    (indices + offsets).reshape(len(indices), -1),
+                    log=np.log,
+                ).reshape(indices.shape),
+                step,
+            )
+            correct = scores[:, np.arange(count), correct_keys]
+            rank.append(np.count_nonzero(scores > correct[..., np.newaxis], axis=-1))
+            total = scores[-1]
 
+        rank = np.concatenate(rank).T.astype(np.uint32)
+        x_rank = (np.arange(rank.shape[1], dtype=np.uint32) + 1) * step
         return rank, x_rank
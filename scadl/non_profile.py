@@ -17,29 +17,65 @@
 # Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
 
 
+import math
 from collections.abc import Callable
-from typing import Optional
+from typing import Optional, Union
 
 import keras
 import numpy as np
 from keras.models import Model
 
+from scadl._pool import process_pool, worker
+from scadl.dataset import TraceDataset, TraceSequence
+from scadl.pipeline import (
+    LABEL_MODES,
+    cache_name,
+    integer_labels,
+    make_dataset,
+    split_indices,
+)
+from scadl.precision import Precision
+from scadl.rank import hypotheses
+from scadl.tools import apply_leakage_model
+
+
+def _train_guess(guess: int, hist_loss: str, **kwargs) -> tuple[list, list]:
+    """Train the model of one guess inside a pool worker"""
+    engine = NonProfile(worker["leakage_model"])
+    acc = engine.train(
+        model=worker["model_builder"](),
+        x_train=worker["x_train"],
+        metadata=worker["metadata"],
+        guess=guess,
+        **kwargs,
+    )
+    return acc, engine.history.history[hist_loss]
+
+
+def _head_key(metric: str, guess: int) -> str:
+    """History key of :metric: for the head of :guess: of the stacked model"""
+    if metric.startswith("val_"):
+        return f"val_guess_{guess}_{metric[4:]}"
+    return f"guess_{guess}_{metric}"
+
 
 class NonProfile:
     """This class is used for Non-profiling DL attacks proposed in https://eprint.iacr.org/2018/196.pdf"""
 
-    def __init__(self, leakage_model: Callable):
-        """It takes a model and a leakagae_model function"""
+    def __init__(self, leakage_model: Callable, precision: Optional[Precision] = None):
+        """It takes a model and a leakagae_model function
+        precision: optional scadl.precision.Precision of the training traces"""
         # super().__init__()
         self.leakage_model = leakage_model
+        self.precision = precision
         self.acc: Optional[np.ndarray] = None
         self.history = None
 
     def train(
         self,
         model: Model,
-        x_train: np.ndarray,
-        metadata: np.ndarray,
+        x_train: Union[np.ndarray, TraceDataset],
+        metadata: Optional[np.ndarray],
         guess: int,
         num_classes: int,
         hist_acc: str,
@@ -47,26 +83,328 @@ class NonProfile:
         batch_size: int = 100,
         validation_split: float = 0.1,
         verbose: int = 1,
+        pipeline: bool = False,
+        cache: Union[bool, str] = False,
+        labels: str = "categorical",
         **kwargs,
     ) -> np.ndarray:
         """
         x_train, metadata: leakages and additional data used for training.
+        x_train may be a TraceDataset streamed from disk, then metadata is None.
+        pipeline: feed the model with a tf.data pipeline (see
+        scadl.pipeline.make_dataset). cache keeps the traces read from disk in
+        memory (True) or in files named after it, which are reused for every
+        guess.
+        labels: "categorical" (one-hot labels of the whole set), "sparse"
+        (integer labels, for a model compiled with the
+        sparse_categorical_crossentropy loss) or "batch" (integer labels
+        one-hot encoded batch by batch).
         From the paper (https://tches.iacr.org/index.php/TCHES/article/view/7387/6559), the attack may work when hist_acc= 'accuracy'
         or 'val_accuracy'"""
-        y_train = np.array([self.leakage_model(i, guess) for i in metadata])
-        y = keras.utils.to_categorical(y_train, num_classes)
-        self.history = model.fit(
-            x=x_train,
-            y=y,
-            epochs=epochs,
-            batch_size=batch_size,
-            validation_split=validation_split,
-            verbose=verbose,
-            **kwargs,
-        )
+        assert labels in LABEL_MODES
+        sparse = labels == "sparse"
+        if self.precision is not None and not isinstance(x_train, TraceDataset):
+            x_train = self.precision.store(x_train)
+        if labels == "batch" and not isinstance(x_train, TraceDataset):
+            x_train = TraceDataset(x_train, metadata)
+
+        if pipeline:
+            if isinstance(x_train, TraceDataset):
+                metadata = x_train.read_metadata(slice(None))
+            y_train = integer_labels(
+                apply_leakage_model(self.leakage_model, metadata, guess)
+            )
+            if sparse:
+                num_classes = None
+            train_indices, validation_indices = split_indices(
+                len(x_train), validation_split
+            )
+            self.history = model.fit(
+                make_dataset(
+                    x_train,
+                    y_train,
+                    train_indices,
+                    batch_size,
+                    num_classes,
+                    shuffle=True,
+                    cache=cache_name(cache, "train"),
+                ),
+                epochs=epochs,
+                validation_data=(
+                    None
+                    if validation_indices is None
+                    else make_dataset(
+                        x_train,
+                        y_train,
+                        validation_indices,
+                        batch_size,
+                        num_classes,
+                        cache=cache_name(cache, "validation"),
+                    )
+                ),
+                verbose=verbose,
+                **kwargs,
+            )
+        elif isinstance(x_train, TraceDataset):
+            train_indices, validation_indices = split_indices(
+                len(x_train), validation_split
+            )
+
+            def batch_labels(batch_metadata: np.ndarray) -> np.ndarray:
+                return self._labels(batch_metadata, guess, num_classes, sparse)
+
+            self.history = model.fit(
+                TraceSequence(x_train, batch_labels, batch_size, train_indices, True),
+                epochs=epochs,
+                validation_data=(
+                    None
+                    if validation_indices is None
+                    else TraceSequence(
+                        x_train, batch_labels, batch_size, validation_indices
+                    )
+                ),
+                verbose=verbose,
+                **kwargs,
+            )
+        else:
+            self.history = model.fit(
+                x=x_train,
+                y=self._labels(metadata, guess, num_classes, sparse),
+                epochs=epochs,
+                batch_size=batch_size,
+                validation_split=validation_split,
+                verbose=verbose,
+                **kwargs,
+            )
 
         acc = self.history.history[hist_acc]
 
         self.acc = acc
 
         return acc
+
+    def _labels(
+        self, metadata: np.ndarray, guess: int, num_classes: int, sparse: bool = False
+    ) -> np.ndarray:
+        """One-hot encoding of the leakage model of :metadata: under :guess:,
+        or the integer labels if :sparse:"""
+        y_train = apply_leakage_model(self.leakage_model, metadata, guess)
+        if sparse:
+            return integer_labels(y_train)
+        return keras.utils.to_categorical(y_train, num_classes)
+
+    def attack_all(
+        self,
+        model_builder: Callable[[], Model],
+        x_train: np.ndarray,
+        metadata: np.ndarray,
+        num_classes: int,
+        hist_acc: str,
+        guess_range: int = 256,
+        epochs: int = 300,
+        batch_size: int = 100,
+        validation_split: float = 0.1,
+        mode: str = "pool",
+        workers: Optional[int] = None,
+        threads: int = 1,
+        verbose: int = 0,
+        **kwargs,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Train one model per guess of range(guess_range).
+
+        model_builder: returns a fresh compiled model at each call.
+        mode:
+        - "pool": the guesses are spread over :workers: processes, each one
+          using :threads: TF threads. model_builder and the leakage model must
+          be picklable (module-level functions or functools.partial).
+        - "stacked": all the guesses are trained as the heads of one wide model
+          sharing the input, with a single call to fit. The heads do not share
+          weights, so each one is trained like a separate model.
+
+        It returns the (guess_range x epochs) matrices of hist_acc and of the
+        matching loss.
+        """
+        assert mode in ("pool", "stacked")
+        hist_loss = "val_loss" if hist_acc.startswith("val_") else "loss"
+        if self.precision is not None:
+            # Stored once, before being sent to the workers
+            x_train = self.precision.store(x_train)
+
+        if mode == "stacked":
+            acc, loss = self._attack_stacked(
+                model_builder,
+                x_train,
+                metadata,
+                num_classes,
+                hist_acc,
+                hist_loss,
+                guess_range,
+                epochs=epochs,
+                batch_size=batch_size,
+                validation_split=validation_split,
+                verbose=verbose,
+                **kwargs,
+            )
+        else:
+            with process_pool(
+                workers,
+                {
+                    "leakage_model": self.leakage_model,
+                    "model_builder": model_builder,
+                    "x_train": x_train,
+                    "metadata": metadata,
+                },
+                threads,
+                None if self.precision is None else self.precision.policy,
+            ) as pool:
+                futures = [
+                    pool.submit(
+                        _train_guess,
+                        guess,
+                        hist_loss,
+                        num_classes=num_classes,
+                        hist_acc=hist_acc,
+                        epochs=epochs,
+                        batch_size=batch_size,
+                        validation_split=validation_split,
+                        verbose=verbose,
+                        **kwargs,
+                    )
+                    for guess in range(guess_range)
+                ]
+                results = [future.result() for future in futures]
+            acc = np.array([result[0] for result in results])
+            loss = np.array([result[1] for result in results])
+
+        self.acc = acc
+        return acc, loss
+
+    def _attack_stacked(
+        self,
+        model_builder: Callable[[], Model],
+        x_train: np.ndarray,
+        metadata: np.ndarray,
+        num_classes: int,
+        hist_acc: str,
+        hist_loss: str,
+        guess_range: int,
+        **kwargs,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Build and train the multi-head model of attack_all"""
+        template = model_builder()
+        metric = hist_acc[4:] if hist_acc.startswith("val_") else hist_acc
+        inputs = keras.Input(shape=x_train.shape[1:])
+        outputs = [
+            keras.layers.Activation("linear", name=f"guess_{guess}")(
+                model_builder()(inputs)
+            )
+            for guess in range(guess_range)
+        ]
+        model = keras.Model(inputs, outputs)
+        model.compile(
+            optimizer=template.optimizer.__class__.from_config(
+                template.optimizer.get_config()
+            ),
+            loss={f"guess_{guess}": template.loss for guess in range(guess_range)},
+            metrics={f"guess_{guess}": [metric] for guess in range(guess_range)},
+        )
+
+        labels = hypotheses(self.leakage_model, metadata, guess_range)
+        y = {
+            f"guess_{guess}": keras.utils.to_categorical(labels[:, guess], num_classes)
+            for guess in range(guess_range)
+        }
+        self.history = model.fit(x=x_train, y=y, **kwargs)
+
+        history = self.history.history
+        acc = np.array([history[_head_key(hist_acc, g)] for g in range(guess_range)])
+        loss = np.array([history[_head_key(hist_loss, g)] for g in range(guess_range)])
+        return acc, loss
+
+
+class SuccessiveHalving:
+    """Successive-halving scheduler for non-profiling attacks.
+
+    All the guesses are trained for :rung_epochs: epochs and ranked by the max
+    of their hist_acc metric so far. The worst :drop_fraction: are dropped and
+    only the survivors are trained for the next rung, until one survivor is
+    left, :max_epochs: is reached or the leader is ahead of the second guess
+    by at least :margin:.
+    """
+
+    def __init__(
+        self,
+        non_profile: NonProfile,
+        model_builder: Callable[[], Model],
+        rung_epochs: int = 5,
+        drop_fraction: float = 0.5,
+        margin: Optional[float] = None,
+    ):
+        """model_builder: returns a fresh compiled model at each call"""
+        assert rung_epochs >= 1
+        assert 0 < drop_fraction < 1
+        self.non_profile = non_profile
+        self.model_builder = model_builder
+        self.rung_epochs = rung_epochs
+        self.drop_fraction = drop_fraction
+        self.margin = margin
+        self.survivors: list[int] = []
+
+    def run(
+        self,
+        x_train: np.ndarray,
+        metadata: np.ndarray,
+        num_classes: int,
+        hist_acc: str,
+        guess_range: int = 256,
+        max_epochs: int = 300,
+        batch_size: int = 100,
+        validation_split: float = 0.1,
+        verbose: int = 0,
+        **kwargs,
+    ) -> np.ndarray:
+        """It returns the (guess_range x max_epochs) hist_acc matrix, with NaN
+        for the epochs a guess has not been trained. The survivors are kept in
+        self.survivors, best guess first."""
+        acc = np.full((guess_range, max_epochs), np.nan)
+        models = {guess: self.model_builder() for guess in range(guess_range)}
+        survivors = list(range(guess_range))
+        epoch = 0
+        while epoch < max_epochs:
+            epochs = min(self.rung_epochs, max_epochs - epoch)
+            for guess in survivors:
+                acc[guess, epoch : epoch + epochs] = self.non_profile.train(
+                    model=models[guess],
+                    x_train=x_train,
+                    metadata=metadata,
+                    guess=guess,
+                    num_classes=num_classes,
+                    hist_acc=hist_acc,
+                    epochs=epochs,
+                    batch_size=batch_size,
+                    validation_split=validation_split,
+                    verbose=verbose,
+                    **kwargs,
+                )
+            epoch += epochs
+
+            scores = np.nanmax(acc[survivors, :epoch], axis=1)
+            order = np.argsort(scores)[::-1]
+            survivors = [survivors[i] for i in order]
+            if epoch >= max_epochs or (
+                self.margin is not None
+                and len(survivors) > 1
+                and scores[order[0]] - scores[order[1]] >= self.margin
+            ):
+                break
+            keep = max(1, math.ceil(len(survivors) * (1 - self.drop_fraction)))
+            for guess in survivors[keep:]:
+                del models[guess]
+            if keep == 1:
+                survivors = survivors[:1]
+                break
+            survivors = survivors[:keep]
+
+        self.survivors = survivors
+        self.non_profile.acc = acc
+        return acc
@@ -0,0 +1,170 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+import math
+from collections.abc import Callable
+from typing import Optional, Union
+
+import numpy as np
+import tensorflow as tf
+
+from scadl.dataset import TraceDataset, read_traces
+
+# Number of cached traces shuffled together when the dataset is cached
+SHUFFLE_BUFFER = 10000
+
+# labels option of the trainers
+LABEL_MODES = ("categorical", "sparse", "batch")
+
+Augmentation = Callable[[np.ndarray, np.ndarray], tuple[np.ndarray, np.ndarray]]
+
+
+def integer_labels(labels: np.ndarray) -> np.ndarray:
+    """Store class labels in the smallest unsigned type, they are one-hot
+    encoded in the graph batch by batch"""
+    labels = np.asarray(labels)
+    return labels.astype(np.min_scalar_type(max(int(labels.max(initial=0)), 0)))
+
+
+def multi_hot(labels: np.ndarray, num_classes: int) -> np.ndarray:
+    """float32 one-hot rows of (N,) labels, or multi-hot rows of (N, bytes)
+    labels: the one-hot rows of the bytes concatenated"""
+    labels = np.asarray(labels).reshape(len(labels), -1)
+    rows = np.zeros((len(labels), labels.shape[1] * num_classes), dtype=np.float32)
+    offsets = np.arange(labels.shape[1]) * num_classes
+    np.put_along_axis(rows, labels.astype(np.intp) + offsets, 1, axis=1)
+    return rows
+
+
+def cache_name(cache: Union[bool, str], split: str) -> Union[bool, str]:
+    """Cache file of one split (e.g. "train", "validation") from the cache
+    option of the trainers"""
+    if isinstance(cache, str):
+        return f"{cache}.{split}"
+    return cache
+
+
+def split_indices(
+    length: int, validation_split: float
+) -> tuple[np.ndarray, Optional[np.ndarray]]:
+    """Training and validation indices split as keras validation_split does:
+    the validation set is the last traces, None when it is empty"""
+    indices = np.arange(length)
+    split = math.floor(length * (1 - validation_split))
+    return indices[:split], indices[split:] if split < length else None
+
+
+def make_dataset(
+    traces: Union[np.ndarray, TraceDataset],
+    labels: np.ndarray,
+    indices: np.ndarray,
+    batch_size: int = 100,
+    num_classes: Optional[int] = None,
+    shuffle: bool = False,
+    cache: Union[bool, str] = False,
+    augmentation: Optional[Augmentation] = None,
+    seed: Optional[int] = None,
+) -> tf.data.Dataset:
+    """Build a tf.data.Dataset of (x, y) float32 batches of traces[indices].
+
+    The traces are never copied, neither for the split nor into a tensor:
+    batches of indices are shuffled, then the traces are gathered with numpy,
+    cast to float32 in parallel and prefetched while the model trains.
+    labels: the class of every trace (one-hot encoded in the graph when
+    num_classes is given) or the targets themselves, e.g. multi-hot labels.
+    With num_classes, (N, bytes) labels give multi-hot rows of bytes x
+    num_classes columns, i.e. the one-hot rows of the bytes concatenated.
+    traces: an in-memory, memory-mapped or h5py array, or a TraceDataset,
+    read batch by batch. For the arrays on disk, :cache: keeps the traces read
+    in memory (True) or in a file (its name) after the first epoch. A cache
+    file holds one split: use another name for other indices (see cache_name).
+    The in-memory cache belongs to the returned dataset, only a cache file is
+    reused by another make_dataset call.
+    augmentation: function (x, y) -> (x, y) applied to every batch, e.g.
+    Mixup or RandomCrop generate.
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    in_memory = isinstance(traces, np.ndarray) and not isinstance(traces, np.memmap)
+    label_tensor = tf.constant(np.asarray(labels))
+    if isinstance(traces, TraceDataset):
+        nb_samples = traces.nb_samples
+        sample_shape = (nb_samples,) + traces.traces.shape[2:]
+    else:
+        sample_shape = traces.shape[1:]
+
+    def encode(y):
+        if num_classes is None:
+            return tf.cast(y, tf.float32)
+        # (batch, bytes) labels give the concatenated one-hot rows (multi-hot)
+        one_hot = tf.one_hot(tf.cast(y, tf.int32), num_classes)
+        return tf.reshape(one_hot, (tf.shape(y)[0], -1))
+
+    def read(batch: np.ndarray) -> np.ndarray:
+        return np.asarray(read_traces(traces, batch), dtype=np.float32)
+
+    def load(batch):
+        # Sorted indices make contiguous reads on disk
+        batch = tf.sort(batch)
+        x = tf.numpy_function(read, [batch], tf.float32)
+        x.set_shape((None,) + tuple(sample_shape))
+        return x, batch
+
+    dataset = tf.data.Dataset.from_tensor_slices(indices)
+    if cache and not in_memory:
+        # Only the traces and their indices are cached, so a cache file of a
+        # split can be reused with other labels (e.g. every non-profiled
+        # guess). With cache=True, every call builds a new in-memory cache.
+        dataset = dataset.batch(batch_size).map(
+            load, num_parallel_calls=tf.data.AUTOTUNE
+        )
+        dataset = dataset.cache("" if cache is True else cache).unbatch()
+        if shuffle:
+            dataset = dataset.shuffle(min(len(indices), SHUFFLE_BUFFER), seed=seed)
+        dataset = dataset.batch(batch_size).apply(
+            tf.data.experimental.assert_cardinality(
+                math.ceil(len(indices) / batch_size)
+            )
+        )
+    else:
+        if shuffle:
+            dataset = dataset.shuffle(len(indices), seed=seed)
+        dataset = dataset.batch(batch_size).map(
+            load, num_parallel_calls=tf.data.AUTOTUNE
+        )
+
+    dataset = dataset.map(
+        lambda x, batch: (x, encode(tf.gather(label_tensor, batch))),
+        num_parallel_calls=tf.data.AUTOTUNE,
+    )
+    if augmentation is not None:
+
+        def augment(x, y):
+            x_aug, y_aug = tf.numpy_function(
+                lambda x, y: tuple(
+                    np.asarray(a, dtype=np.float32) for a in augmentation(x, y)
+                ),
+                [x, y],
+                [tf.float32, tf.float32],
+            )
+            x_aug.set_shape(x.shape)
+            y_aug.set_shape(y.shape)
+            return x_aug, y_aug
+
+        dataset = dataset.map(augment, num_parallel_calls=tf.data.AUTOTUNE)
+    return dataset.prefetch(tf.data.AUTOTUNE)
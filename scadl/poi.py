@@ -0,0 +1,176 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from collections.abc import Callable
+from typing import Union
+
+import numpy as np
+
+from scadl.dataset import TraceDataset, iter_chunks
+from scadl.tools import apply_leakage_model
+
+Labels = Union[np.ndarray, Callable]
+
+
+class ClassStatistics:
+    """Per-class count, sum and sum of squares of every sample.
+
+    They are accumulated over chunks of traces, so SNR, NICV and t-test can be
+    computed in one streaming pass over a trace set which does not fit in RAM.
+    """
+
+    def __init__(self, num_classes: int):
+        self.num_classes = num_classes
+        self.counts = np.zeros(num_classes, dtype=np.int64)
+        self.sums = None
+        self.squares = None
+
+    def partial_fit(self, traces: np.ndarray, labels: np.ndarray) -> "ClassStatistics":
+        """Update the statistics with a chunk of traces and their labels"""
+        traces = np.asarray(traces, dtype=np.float64)
+        labels = np.asarray(labels).astype(np.intp)
+        assert len(traces) == len(labels)
+        assert labels.min(initial=0) >= 0 and labels.max(initial=0) < self.num_classes
+        if self.sums is None:
+            self.sums = np.zeros((self.num_classes, traces.shape[1]))
+            self.squares = np.zeros((self.num_classes, traces.shape[1]))
+        if len(traces) == 0:
+            return self
+
+        # Sorting by class makes one reduceat per chunk instead of one sum per class
+        order = np.argsort(labels, kind="stable")
+        classes, starts = np.unique(labels[order], return_index=True)
+        traces = traces[order]
+        self.counts += np.bincount(labels, minlength=self.num_classes)
+        self.sums[classes] += np.add.reduceat(traces, starts)
+        self.squares[classes] += np.add.reduceat(np.square(traces), starts)
+        return self
+
+    def fit(
+        self,
+        traces: Union[np.ndarray, TraceDataset],
+        labels: Labels,
+        chunk_size: int = 10000,
+    ) -> "ClassStatistics":
+        """Accumulate the statistics of :traces: chunk by chunk (see
+        scadl.dataset.iter_chunks). labels is either the array of labels or,
+        for a TraceDataset, a leakage model applied to its metadata.
+        """
+        if callable(labels):
+            assert isinstance(traces, TraceDataset)
+            for chunk, metadata in iter_chunks(traces, chunk_size=chunk_size):
+                self.partial_fit(chunk, apply_leakage_model(labels, metadata))
+        else:
+            for chunk in iter_chunks(traces, labels, chunk_size):
+                self.partial_fit(*chunk)
+        return self
+
+    def _present(self) -> np.ndarray:
+        return self.counts > 0
+
+    def means(self) -> np.ndarray:
+        """Per-class means of the classes present, shape (classes, samples)"""
+        present = self._present()
+        return self.sums[present] / self.counts[present, np.newaxis]
+
+    def variances(self) -> np.ndarray:
+        """Per-class variances of the classes present, shape (classes, samples)"""
+        present = self._present()
+        means = self.means()
+        return self.squares[present] / self.counts[present, np.newaxis] - means**2
+
+    def snr(self) -> np.ndarray:
+        """Signal-to-noise ratio: variance of the class means over the mean of
+        the class variances"""
+        return np.var(self.means(), axis=0) / np.mean(self.variances(), axis=0)
+
+    def nicv(self) -> np.ndarray:
+        """Normalized inter-class variance: Var(E[X|Y]) / Var(X).
+
+        Ref: https://eprint.iacr.org/2013/717.pdf
+        """
+        total = self.counts.sum()
+        mean = self.sums.sum(axis=0) / total
+        variance = self.squares.sum(axis=0) / total - mean**2
+        weights = self.counts[self._present()] / total
+        inter = np.sum(weights[:, np.newaxis] * (self.means() - mean) ** 2, axis=0)
+        return inter / variance
+
+    def ttest(self) -> np.ndarray:
+        """Welch's t-test between class 0 and class 1 (e.g. fixed vs random)"""
+        assert self.num_classes == 2 and self._present().all()
+        means = self.means()
+        variances = self.variances()
+        return (means[0] - means[1]) / np.sqrt(
+            variances[0] / self.counts[0] + variances[1] / self.counts[1]
+        )
+
+
+def snr(
+    traces: Union[np.ndarray, TraceDataset],
+    labels: Labels,
+    num_classes: int = 256,
+    chunk_size: int = 10000,
+) -> np.ndarray:
+    """SNR of every sample of :traces: for the classes given by :labels:"""
+    return ClassStatistics(num_classes).fit(traces, labels, chunk_size).snr()
+
+
+def nicv(
+    traces: Union[np.ndarray, TraceDataset],
+    labels: Labels,
+    num_classes: int = 256,
+    chunk_size: int = 10000,
+) -> np.ndarray:
+    """NICV of every sample of :traces: for the classes given by :labels:"""
+    return ClassStatistics(num_classes).fit(traces, labels, chunk_size).nicv()
+
+
+def ttest(
+    traces: Union[np.ndarray, TraceDataset],
+    groups: Labels,
+    chunk_size: int = 10000,
+) -> np.ndarray:
+    """Fixed-vs-random t-test of every sample.
+
+    groups: 0 for the fixed traces and 1 for the random ones.
+    """
+    return ClassStatistics(2).fit(traces, groups, chunk_size).ttest()
+
+
+def select_poi(scores: np.ndarray, nb_windows: int = 1, width: int = 10) -> list[slice]:
+    """Return the :nb_windows: windows of :width: samples around the highest
+    :scores: (e.g. SNR or |t|), best first and without overlap."""
+    scores = np.nan_to_num(np.asarray(scores, dtype=np.float64), nan=-np.inf)
+    windows = []
+    for _ in range(nb_windows):
+        peak = int(np.argmax(scores))
+        if scores[peak] == -np.inf:
+            break
+        start = min(max(0, peak - width // 2), max(0, len(scores) - width))
+        windows.append(slice(start, start + width))
+        # Any peak left there would give a window overlapping this one
+        scores[max(0, start - width) : start + 2 * width] = -np.inf
+    return windows
+
+
+def poi_indices(windows: list[slice]) -> np.ndarray:
+    """Sorted sample indices of :windows:, to be passed as TraceDataset samples
+    or to slice the traces before training"""
+    return np.unique(np.concatenate([np.arange(w.start, w.stop) for w in windows]))
@@ -0,0 +1,136 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from collections.abc import Callable
+from pathlib import Path
+
+import keras
+import numpy as np
+
+from scadl.rank import key_rank, zero_policy
+
+# CPU flags of the bf16 instructions used by the TF/oneDNN kernels
+BF16_FLAGS = ("avx512_bf16", "amx_bf16")
+
+
+def cpu_supports_bf16() -> bool:
+    """True if the CPU has native bf16 instructions (Linux only)"""
+    try:
+        cpuinfo = Path("/proc/cpuinfo").read_text(encoding="utf-8")
+    except OSError:
+        return False
+    for line in cpuinfo.splitlines():
+        if line.startswith("flags"):
+            flags = line.split(":", 1)[1].split()
+            return any(flag in flags for flag in BF16_FLAGS)
+    return False
+
+
+class Precision:
+    """Precision policy of the traces, the model and the predictions.
+
+    storage: dtype the traces are kept in. "float16" halves the memory of
+    float32 traces. "int8" keeps raw oscilloscope samples (e.g. the ASCAD
+    traces) as they are. The batches are cast to float32 only when they are
+    fed to the model (keras and scadl.pipeline do it batch by batch).
+    compute: "float32", "mixed_bfloat16", "mixed_float16" or "auto", which
+    selects mixed_bfloat16 on CPUs with bf16 instructions and float32
+    otherwise. Mixed policies have to be applied before building the model
+    (see apply), and its last layer should output float32, e.g.
+    Activation("softmax", dtype="float32").
+    predictions: dtype the predictions are stored in for the rank.
+    """
+
+    storages = ("float32", "float16", "int8")
+    computes = ("float32", "mixed_bfloat16", "mixed_float16", "auto")
+    prediction_types = ("float32", "float16")
+
+    def __init__(
+        self,
+        storage: str = "float32",
+        compute: str = "float32",
+        predictions: str = "float32",
+    ):
+        assert storage in self.storages
+        assert compute in self.computes
+        assert predictions in self.prediction_types
+        self.storage = storage
+        self.compute = compute
+        self.predictions = predictions
+
+    @property
+    def policy(self) -> str:
+        """Name of the keras dtype policy"""
+        if self.compute == "auto":
+            return "mixed_bfloat16" if cpu_supports_bf16() else "float32"
+        return self.compute
+
+    def apply(self):
+        """Set the keras global policy, call it before building the model"""
+        keras.mixed_precision.set_global_policy(self.policy)
+
+    def store(self, traces: np.ndarray) -> np.ndarray:
+        """Return :traces: in the storage dtype, without copy when they
+        already are"""
+        if self.storage == "int8":
+            traces = np.asarray(traces)
+            assert np.issubdtype(traces.dtype, np.integer)
+            assert traces.min(initial=0) >= -128 and traces.max(initial=0) <= 127
+        return np.asarray(traces, dtype=self.storage)
+
+    def store_predictions(self, predictions: np.ndarray) -> np.ndarray:
+        """Return :predictions: in the predictions dtype"""
+        return np.asarray(predictions, dtype=self.predictions)
+
+
+def check_predictions(
+    reference: np.ndarray,
+    predictions: np.ndarray,
+    leakage_model: Callable,
+    metadata: np.ndarray,
+    guess_range: int,
+    correct_key: int,
+    step: int,
+    max_rank_delta: int = 1,
+    min_agreement: float = 0.99,
+) -> bool:
+    """Accuracy regression check of a reduced precision.
+
+    reference: predictions of the float32 model on the attack traces,
+    predictions: the same with the reduced precision (storage, compute or
+    predictions dtype). It checks that both predict the same class on at least
+    :min_agreement: of the traces and that the key ranks after every :step: traces
+    differ by at most :max_rank_delta:.
+    """
+    assert reference.shape == predictions.shape
+    agreement = np.mean(np.argmax(reference, axis=1) == np.argmax(predictions, axis=1))
+    rank_reference, _ = key_rank(
+        reference, leakage_model, metadata, guess_range, correct_key, step
+    )
+    rank, _ = key_rank(
+        predictions,
+        leakage_model,
+        metadata,
+        guess_range,
+        correct_key,
+        step,
+        zero=zero_policy(predictions),
+    )
+    delta = np.abs(rank_reference.astype(np.int64) - rank.astype(np.int64)).max()
+    return bool(agreement >= min_agreement and delta <= max_rank_delta)
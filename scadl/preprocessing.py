@@ -0,0 +1,156 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from scadl.dataset import TraceDataset, iter_chunks
+from scadl.tools import is_valid
+
+
+class Scaler:
+    """Streaming version of scadl.tools normalization, standardize and remove_avg.
+
+    The per-sample statistics (count, mean, variance, min, max) are accumulated
+    over chunks in one pass with Welford/Chan updates, so the whole trace set
+    never has to be in memory. The fitted scaler is saved next to the model and
+    applied to the attack traces, which keeps the profiling and the attack
+    scaling identical.
+
+    Note that normalization(remove_avg(x)) is the same as normalization(x).
+    """
+
+    methods = ("normalization", "standardize", "remove_avg")
+
+    def __init__(
+        self,
+        method: str = "normalization",
+        feature_range: tuple[float, float] = (0, 1),
+    ):
+        assert method in self.methods
+        assert feature_range[0] < feature_range[1]
+        self.method = method
+        self.feature_range = feature_range
+        self.count = 0
+        self.mean: Optional[np.ndarray] = None
+        self.m2: Optional[np.ndarray] = None
+        self.minimum: Optional[np.ndarray] = None
+        self.maximum: Optional[np.ndarray] = None
+
+    def partial_fit(self, data: np.ndarray) -> "Scaler":
+        """Update the statistics with a chunk of traces"""
+        data = np.asarray(data)
+        count = len(data)
+        if count == 0:
+            return self
+        mean = data.mean(axis=0, dtype=np.float64)
+        m2 = np.square(data - mean).sum(axis=0)
+        minimum = data.min(axis=0).astype(np.float64)
+        maximum = data.max(axis=0).astype(np.float64)
+
+        if self.count == 0:
+            self.mean, self.m2 = mean, m2
+            self.minimum, self.maximum = minimum, maximum
+        else:
+            total = self.count + count
+            delta = mean - self.mean
+            self.mean = self.mean + delta * (count / total)
+            self.m2 = self.m2 + m2 + np.square(delta) * (self.count * count / total)
+            self.minimum = np.minimum(self.minimum, minimum)
+            self.maximum = np.maximum(self.maximum, maximum)
+        self.count += count
+        return self
+
+    def fit(
+        self, data: Union[np.ndarray, TraceDataset], chunk_size: int = 10000
+    ) -> "Scaler":
+        """Compute the statistics of :data: chunk by chunk (see
+        scadl.dataset.iter_chunks)"""
+        for chunk, _ in iter_chunks(data, chunk_size=chunk_size):
+            self.partial_fit(chunk)
+        return self
+
+    @property
+    def std(self) -> np.ndarray:
+        """Per-sample standard deviation (as np.std, ddof=0)"""
+        return np.sqrt(self.m2 / self.count)
+
+    def coefficients(self) -> tuple[np.ndarray, np.ndarray]:
+        """Return the float32 (scale, offset) of transform(x) = x * scale + offset"""
+        assert self.count > 0
+        if self.method == "remove_avg":
+            scale = np.ones_like(self.mean)
+            offset = -self.mean
+        elif self.method == "standardize":
+            scale = 1 / self.std
+            offset = -self.mean * scale
+        else:
+            low, high = self.feature_range
+            scale = (high - low) / (self.maximum - self.minimum)
+            offset = low - self.minimum * scale
+        return scale.astype(np.float32), offset.astype(np.float32)
+
+    def transform(
+        self, data: np.ndarray, copy: bool = True, check: bool = True
+    ) -> np.ndarray:
+        """Scale a batch of traces in float32.
+
+        If :copy: is False and data is already a float32 array, it is
+        transformed in place. If :check: is True, the result is checked for
+        invalid values.
+        """
+        scale, offset = self.coefficients()
+        if copy:
+            data = np.array(data, dtype=np.float32)
+        else:
+            data = np.asarray(data, dtype=np.float32)
+        data *= scale
+        data += offset
+
+        if check:
+            assert is_valid(data)
+
+        return data
+
+    def save(self, path: Union[str, Path]):
+        """Save the scaler as a .npz file"""
+        np.savez(
+            path,
+            method=self.method,
+            feature_range=self.feature_range,
+            count=self.count,
+            mean=self.mean,
+            m2=self.m2,
+            minimum=self.minimum,
+            maximum=self.maximum,
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "Scaler":
+        """Load a scaler saved with :save:"""
+        with np.load(path) as file:
+            scaler = cls(str(file["method"]), tuple(file["feature_range"]))
+            scaler.count = int(file["count"])
+            scaler.mean = file["mean"]
+            scaler.m2 = file["m2"]
+            scaler.minimum = file["minimum"]
+            scaler.maximum = file["maximum"]
+        return scaler
@@ -17,23 +17,38 @@
 # Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
 
 from collections.abc import Callable
-from typing import Optional
+from typing import Optional, Union
 
 import keras
 import numpy as np
 from keras.models import Model
 from sklearn.model_selection import train_test_split
 
+from scadl.cache import PredictionCache
+from scadl.dataset import TraceDataset, TraceSequence
+from scadl.pipeline import LABEL_MODES, cache_name, integer_labels, make_dataset
+from scadl.precision import Precision
+from scadl.rank import key_rank, zero_policy
+from scadl.tools import apply_leakage_model
+
 
 class Profile:
     """This class is used for normal profiling.
     It takes two argiments: the DL model and the leakage model
     """
 
-    def __init__(self, model: Model, leakage_model: Callable[[np.ndarray], int]):
+    def __init__(
+        self,
+        model: Model,
+        leakage_model: Callable[[np.ndarray], int],
+        precision: Optional[Precision] = None,
+    ):
+        """precision: optional scadl.precision.Precision of the training
+        traces"""
         super().__init__()
         self.model = model
         self.leakage_model = leakage_model
+        self.precision = precision
         self.data_aug: Optional[
             Callable[[np.ndarray, np.ndarray], tuple[np.ndarray, np.ndarray]]
         ] = None
@@ -48,25 +63,114 @@ class Profile:
 
     def train(
         self,
-        x_train: np.ndarray,
-        metadata: np.ndarray,
+        x_train: Union[np.ndarray, TraceDataset],
+        metadata: Optional[np.ndarray],
         guess_range: int,
         epochs: int = 300,
         batch_size: int = 100,
         validation_split: float = 0.1,
         data_augmentation: bool = False,
         verbose: int = 1,
+        augment_batches: bool = False,
+        pipeline: bool = False,
+        cache: Union[bool, str] = False,
+        labels: str = "categorical",
         **kwargs,
     ):
         """This function is used to train the model
-        x_train: poi from leakages
+        x_train: poi from leakages, or a TraceDataset streamed from disk
         metadata: the plaintexts, keys, ciphertexts used for profiling
+        (None for a TraceDataset which holds its metadata)
+        augment_batches: apply the data augmentation to every training batch
+        instead of enlarging the whole dataset (always the case for a
+        TraceDataset)
+        pipeline: feed the model with a tf.data pipeline (see
+        scadl.pipeline.make_dataset) which splits by index, one-hot encodes
+        the labels in the graph and prefetches the batches. cache keeps the
+        traces read from disk in memory (True) or in files named after it; the
+        split is random, so use a new name for every call.
+        labels:
+        - "categorical": one-hot labels of the whole training set,
+        - "sparse": integer labels, for a model compiled with the
+          sparse_categorical_crossentropy loss, without data_augmentation
+          (mixup would average the class ids),
+        - "batch": integer labels one-hot encoded batch by batch, so the
+          labels take N bytes and mixup is applied to every batch.
         """
 
         assert self.data_aug is not None
+        assert labels in LABEL_MODES
+        sparse = labels == "sparse"
+        assert not (sparse and data_augmentation)
+
+        if self.precision is not None and not isinstance(x_train, TraceDataset):
+            x_train = self.precision.store(x_train)
+
+        if pipeline:
+            if isinstance(x_train, TraceDataset):
+                metadata = x_train.read_metadata(slice(None))
+            y_train = integer_labels(apply_leakage_model(self.leakage_model, metadata))
+            num_classes = None if sparse else guess_range
+            train_indices, test_indices = train_test_split(
+                np.arange(len(x_train)), test_size=validation_split
+            )
+            self.history = self.model.fit(
+                make_dataset(
+                    x_train,
+                    y_train,
+                    train_indices,
+                    batch_size,
+                    num_classes,
+                    shuffle=True,
+                    cache=cache_name(cache, "train"),
+                    augmentation=self.data_aug if data_augmentation else None,
+                ),
+                epochs=epochs,
+                verbose=verbose,
+                validation_data=make_dataset(
+                    x_train,
+                    y_train,
+                    test_indices,
+                    batch_size,
+                    num_classes,
+                    cache=cache_name(cache, "validation"),
+                ),
+                **kwargs,
+            )
+            return
 
-        y_train = np.array([self.leakage_model(m) for m in metadata])
-        y_train = keras.utils.to_categorical(y_train, guess_range)
+        if (augment_batches or labels == "batch") and not isinstance(
+            x_train, TraceDataset
+        ):
+            x_train = TraceDataset(x_train, metadata)
+
+        if isinstance(x_train, TraceDataset):
+            train_indices, test_indices = train_test_split(
+                np.arange(len(x_train)), test_size=validation_split
+            )
+
+            def batch_labels(batch_metadata: np.ndarray) -> np.ndarray:
+                return self._labels(batch_metadata, guess_range, sparse)
+
+            self.history = self.model.fit(
+                TraceSequence(
+                    x_train,
+                    batch_labels,
+                    batch_size,
+                    train_indices,
+                    shuffle=True,
+                    augmentation=self.data_aug if data_augmentation else None,
+                ),
+                epochs=epochs,
+                verbose=verbose,
+                validation_data=TraceSequence(
+                    x_train, batch_labels, batch_size, test_indices
+                ),
+                **kwargs,
+            )
+            return
+
+        y_train = self._labels(metadata, guess_range, sparse)
         if data_augmentation:
             x, y = self.data_aug(x_train, y_train)
         else:
@@ -85,6 +189,16 @@ class Profile:
             **kwargs,
         )
 
+    def _labels(
+        self, metadata: np.ndarray, guess_range: int, sparse: bool = False
+    ) -> np.ndarray:
+        """One-hot encoding of the leakage model of :metadata:, or the
+        integer labels if :sparse:"""
+        y = apply_leakage_model(self.leakage_model, metadata)
+        if sparse:
+            return integer_labels(y)
+        return keras.utils.to_categorical(y, guess_range)
+
     def save_model(self, name: str):
         """It accepts a str to save the file name"""
         self.model.save(name)
@@ -93,45 +207,87 @@ class Profile:
 class Match:
     """This class is used for testing the attack after the profiling phase"""
 
-    def __init__(self, model: Model, leakage_model: Callable[[np.ndarray, int], int]):
+    def __init__(
+        self,
+        model: Model,
+        leakage_model: Callable[[np.ndarray, int], int],
+        precision: Optional[Precision] = None,
+        reduction: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+    ):
         """model: after training the profile model this is fed to this class to test the attack
         leakage_model: The same leakage model used for profiling
+        precision: optional scadl.precision.Precision of the attack traces and
+        of the predictions
+        reduction: optional fitted scadl.reduction.PCA or LDA of the profiling
+        traces, applied to the attack traces batch by batch
         """
         super().__init__()
         self.model = model
         self.leakage_model = leakage_model
+        self.precision = precision
+        self.reduction = reduction
 
     def match(
         self,
-        x_test: np.ndarray,
-        metadata: np.ndarray,
+        x_test: Union[np.ndarray, TraceDataset],
+        metadata: Optional[np.ndarray],
         guess_range: int,
         correct_key: int,
         step: int,
+        batch_size: int = 100,
+        predictions: Optional[np.ndarray] = None,
+        cache: Optional[PredictionCache] = None,
     ) -> tuple[np.ndarray, np.ndarray]:
         """They key rank is implemented based on the sum of np.log() of the prob
         success rate is calculated as shown in https://eprint.iacr.org/2006/139.pdf
+        leakage_model may be vectorized (see scadl.tools.vectorized) to compute
+        the indices of all the traces and guesses in one call.
+        x_test may be a TraceDataset streamed from disk, then metadata is None.
+        predictions: outputs of the model on x_test computed beforehand, no
+        inference is run then.
+        cache: a PredictionCache reused across the calls on the same traces.
         """
-        predictions = self.model.predict(x_test)
-
-        chunk_starts = range(0, len(x_test), step)
-        rank = np.zeros(len(chunk_starts), dtype=np.uint32)
-        x_rank = np.zeros(len(chunk_starts), dtype=np.uint32)
-        number_traces = 0
-        rank_array = np.zeros(guess_range)
-        for i, chunk_start in enumerate(chunk_starts):
-            pred_chunk = predictions[chunk_start : chunk_start + step]
-            metadata_chunk = metadata[chunk_start : chunk_start + step]
-            for row in range(len(pred_chunk)):
-                for guess in range(guess_range):
-                    index = self.leakage_model(metadata_chunk[row], guess)
-                    if pred_chunk[row, index] != 0:
-                        rank_array[guess] += np.log2(pred_chunk[row, index])
-            rank[i] = np.where(sorted(rank_array)[::-1] == rank_array[correct_key])[0][
-                0
-            ]
-
-            number_traces += step
-            x_rank[i] = number_traces
-
-        return rank, x_rank
+        if isinstance(x_test, TraceDataset):
+            metadata = x_test.metadata
+        elif self.precision is not None and predictions is None:
+            x_test = self.precision.store(x_test)
+        if self.reduction is not None and predictions is None:
+            x_test = self._reduced(x_test, metadata)
+        if predictions is not None:
+            assert len(predictions) == len(metadata)
+        elif cache is not None:
+            predictions = cache.predict(self.model, x_test, batch_size)
+        elif isinstance(x_test, TraceDataset):
+            predictions = self.model.predict(
+                TraceSequence(x_test, batch_size=batch_size)
+            )
+        else:
+            predictions = self.model.predict(x_test, batch_size=batch_size)
+        if self.precision is not None:
+            predictions = self.precision.store_predictions(predictions)
+
+        return key_rank(
+            predictions,
+            self.leakage_model,
+            metadata,
+            guess_range,
+            correct_key,
+            step,
+            zero=zero_policy(predictions),
+        )
+
+    def _reduced(
+        self, x_test: Union[np.ndarray, TraceDataset], metadata: np.ndarray
+    ) -> TraceDataset:
+        """x_test as a TraceDataset reduced when the batches are read"""
+        if not isinstance(x_test, TraceDataset):
+            return TraceDataset(x_test, metadata, transform=self.reduction)
+        transform = x_test.transform
+        if transform is None:
+            reduction = self.reduction
+        else:
+
+            def reduction(traces: np.ndarray) -> np.ndarray:
+                return self.reduction(transform(traces))
+
+        return TraceDataset(x_test.traces, metadata, x_test.samples, reduction)
@@ -0,0 +1,404 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from collections.abc import Callable
+from statistics import NormalDist
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from scadl.tools import is_vectorized
+
+# Number of traces processed at once by key_rank, it bounds the size of the
+# (traces x guesses) intermediate matrices.
+BLOCK_TRACES = 1 << 14
+
+
+def hypotheses(
+    leakage_model: Callable, metadata: np.ndarray, guess_range: int
+) -> np.ndarray:
+    """Return the (len(metadata), guess_range) matrix of leakage_model indices.
+
+    Vectorized leakage models (see scadl.tools.vectorized and
+    scadl.leakage_compiler.tabulated) are called once, scalar ones
+    leakage_model(data, guess) go through an adapter.
+    """
+    guesses = np.arange(guess_range)
+    if is_vectorized(leakage_model):
+        return np.asarray(leakage_model(metadata, guesses))
+    return scalar_hypotheses(leakage_model, metadata, guesses)
+
+
+def broadcasts(leakage_model: Callable, data, guesses: np.ndarray) -> bool:
+    """Whether the scalar leakage_model(data, guesses) called with an array of
+    guesses returns the scalar calls of every guess on the record :data:"""
+    try:
+        row = np.asarray(leakage_model(data, guesses))
+        return row.shape == guesses.shape and all(
+            row[index] == leakage_model(data, guess)
+            for index, guess in enumerate(guesses)
+        )
+    except (TypeError, ValueError, IndexError):
+        return False
+
+
+def scalar_hypotheses(
+    leakage_model: Callable, metadata: np.ndarray, guesses: np.ndarray
+) -> np.ndarray:
+    """Adapter for scalar leakage models.
+
+    Most of them (e.g. sbox[guess ^ data["plaintext"][2]]) broadcast over an
+    array of guesses, which costs one call per trace instead of one call per
+    trace and guess. It is only used when it matches the scalar calls on the
+    first trace.
+    """
+    indices = np.empty((len(metadata), len(guesses)), dtype=np.intp)
+    if len(metadata) == 0:
+        return indices
+    broadcast = broadcasts(leakage_model, metadata[0], guesses)
+
+    for n, data in enumerate(metadata):
+        if broadcast:
+            indices[n] = leakage_model(data, guesses)
+        else:
+            indices[n] = [leakage_model(data, guess) for guess in guesses]
+    return indices
+
+
+def log_likelihoods(
+    predictions: np.ndarray,
+    indices: np.ndarray,
+    log: Callable[[np.ndarray], np.ndarray] = np.log2,
+    zero: str = "skip",
+) -> np.ndarray:
+    """Gather predictions[n, indices[n, g]] and return their log as float64.
+
+    zero selects how null probabilities are handled:
+    - "skip": they do not contribute to the score (log taken as 0),
+    - "min": they are replaced by the smallest non-null probability of the trace.
+    """
+    assert zero in ("skip", "min")
+    assert len(predictions) == len(indices)
+
+    rows = np.arange(len(predictions))[:, np.newaxis]
+    probs = predictions[rows, indices].astype(np.float64)
+    nulls = probs == 0
+    if zero == "min":
+        floor = np.where(predictions > 0, predictions, np.inf).min(axis=1)
+        probs = np.where(nulls, floor[:, np.newaxis].astype(np.float64), probs)
+        nulls = np.zeros_like(nulls)
+    with np.errstate(divide="ignore"):
+        scores = log(probs)
+    scores[nulls] = 0
+    return scores
+
+
+def zero_policy(predictions: np.ndarray) -> str:
+    """Zero policy of :predictions:: "min" when they are stored in less than
+    32 bits (e.g. float16), whose small probabilities underflow to 0 and
+    would otherwise be skipped, "skip" else"""
+    return "min" if np.asarray(predictions).dtype.itemsize < 4 else "skip"
+
+
+def log_likelihood_matrix(
+    predictions: np.ndarray,
+    leakage_model: Callable,
+    metadata: np.ndarray,
+    guess_range: int,
+    log: Callable[[np.ndarray], np.ndarray] = np.log2,
+    zero: str = "skip",
+) -> np.ndarray:
+    """Return the (N, guess_range) per-trace log-likelihood of every guess."""
+    assert len(predictions) == len(metadata)
+
+    matrix = np.empty((len(predictions), guess_range))
+    for start in range(0, len(predictions), BLOCK_TRACES):
+        stop = start + BLOCK_TRACES
+        indices = hypotheses(leakage_model, metadata[start:stop], guess_range)
+        matrix[start:stop] = log_likelihoods(
+            predictions[start:stop], indices, log, zero
+        )
+    return matrix
+
+
+def chunk_scores(log_likelihood: np.ndarray, step: int) -> np.ndarray:
+    """Return the cumulative guess scores after each chunk of :step: traces.
+
+    log_likelihood has shape (N, G), the result has shape (ceil(N / step), G).
+    """
+    assert step >= 1
+    sums = np.add.reduceat(log_likelihood, np.arange(0, len(log_likelihood), step))
+    return np.cumsum(sums, axis=0)
+
+
+def ranks(scores: np.ndarray, correct_key: int) -> np.ndarray:
+    """Rank of :correct_key: along the last axis of :scores:.
+
+    It is the number of guesses scoring strictly higher than the correct key,
+    which is what sorting the scores and looking up the correct one gives.
+    """
+    correct = scores[..., correct_key, np.newaxis]
+    return np.count_nonzero(scores > correct, axis=-1).astype(np.uint32)
+
+
+def key_rank(
+    predictions: np.ndarray,
+    leakage_model: Callable,
+    metadata: np.ndarray,
+    guess_range: int,
+    correct_key: int,
+    step: int,
+    log: Callable[[np.ndarray], np.ndarray] = np.log2,
+    zero: str = "skip",
+) -> tuple[np.ndarray, np.ndarray]:
+    """Compute the key rank every :step: traces without Python loops per trace.
+
+    It returns the same (rank, x_rank) tuple as Match.match.
+    """
+    assert len(predictions) > 0 and len(predictions) == len(metadata)
+    assert correct_key < guess_range
+    assert step >= 1
+
+    def block_scores(index: slice) -> np.ndarray:
+        indices = hypotheses(leakage_model, metadata[index], guess_range)
+        return log_likelihoods(predictions[index], indices, log, zero)
+
+    return accumulated_ranks(
+        block_scores, len(predictions), guess_range, correct_key, step
+    )
+
+
+def accumulated_ranks(
+    log_likelihood: Callable[[slice], np.ndarray],
+    length: int,
+    guess_range: int,
+    correct_key: int,
+    step: int,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Rank of :correct_key: every :step: of :length: traces.
+
+    log_likelihood(index) returns the (n, guess_range) log-likelihoods of the
+    traces of a slice, it is called block by block so that the intermediate
+    matrices stay below BLOCK_TRACES rows. It returns (rank, x_rank).
+    """
+    block = max(step, BLOCK_TRACES // step * step)
+    rank = []
+    total = np.zeros(guess_range)
+    for start in range(0, length, block):
+        scores = total + chunk_scores(log_likelihood(slice(start, start + block)), step)
+        rank.append(ranks(scores, correct_key))
+        total = scores[-1]
+
+    rank = np.concatenate(rank)
+    x_rank = (np.arange(len(rank), dtype=np.uint32) + 1) * step
+    return rank, x_rank
+
+
+class GuessingEntropy(NamedTuple):
+    """Result of guessing_entropy, one value per chunk of traces.
+
+    The confidence intervals have shape (2, chunks): lower and upper bounds.
+    """
+
+    mean_rank: np.ndarray
+    x_rank: np.ndarray
+    success_rate: np.ndarray
+    mean_rank_ci: np.ndarray
+    success_rate_ci: np.ndarray
+
+
+def guessing_entropy(
+    log_likelihood: np.ndarray,
+    correct_key: int,
+    step: int,
+    num_attacks: int,
+    nb_traces: Optional[int] = None,
+    memory: int = 1 << 28,
+    confidence: float = 0.95,
+    seed: Optional[int] = None,
+) -> GuessingEntropy:
+    """Evaluate :num_attacks: random orderings of the attack traces at once.
+
+    log_likelihood: the (N, G) matrix given by log_likelihood_matrix, computed
+    once for all the attacks.
+    nb_traces: number of traces drawn for each attack, all of them by default.
+    memory: budget in bytes of the (attacks x traces x G) intermediate array
+    and of the random permutations, the attacks and the traces are processed
+    in blocks to stay below it.
+
+    The success rate is the fraction of attacks where the correct key ranks
+    first. Confidence intervals use the normal approximation for the mean rank
+    and the Wilson score interval for the success rate.
+    """
+    assert len(log_likelihood) > 0
+    assert correct_key < log_likelihood.shape[1]
+    assert step >= 1
+    assert num_attacks >= 1
+
+    guess_range = log_likelihood.shape[1]
+    if nb_traces is None:
+        nb_traces = len(log_likelihood)
+    assert 1 <= nb_traces <= len(log_likelihood)
+    nb_chunks = len(range(0, nb_traces, step))
+    row_bytes = guess_range * log_likelihood.itemsize
+    block = min(nb_chunks * step, max(step, memory // row_bytes // step * step))
+    index_bytes = np.dtype(np.intp).itemsize
+    batch = max(
+        1, min(memory // (block * row_bytes), memory // (nb_traces * index_bytes))
+    )
+    # Attacks shuffled at once: random keys and their argsort over all traces
+    draws = max(1, memory // (len(log_likelihood) * (8 + index_bytes)))
+
+    rng = np.random.default_rng(seed)
+    rank = np.empty((num_attacks, nb_chunks), dtype=np.uint32)
+    for first in range(0, num_attacks, batch):
+        nb = min(batch, num_attacks - first)
+        permutations = np.empty((nb, nb_traces), dtype=np.intp)
+        for attack in range(0, nb, draws):
+            keys = rng.random((min(draws, nb - attack), len(log_likelihood)))
+            permutations[attack : attack + draws] = np.argsort(keys, axis=1)[
+                :, :nb_traces
+            ]
+        total = np.zeros((nb, 1, guess_range))
+        for start in range(0, nb_traces, block):
+            ll = log_likelihood[permutations[:, start : start + block]]
+            sums = np.add.reduceat(ll, np.arange(0, ll.shape[1], step), axis=1)
+            scores = total + np.cumsum(sums, axis=1)
+            chunk = start // step
+            rank[first : first + nb, chunk : chunk + scores.shape[1]] = ranks(
+                scores, correct_key
+            )
+            total = scores[:, -1:]
+
+    z = NormalDist().inv_cdf(0.5 + confidence / 2)
+    mean_rank = rank.mean(axis=0)
+    std = rank.std(axis=0, ddof=1) if num_attacks > 1 else np.zeros(nb_chunks)
+    margin = z * std / np.sqrt(num_attacks)
+
+    success_rate = np.mean(rank == 0, axis=0)
+    center = (success_rate + z**2 / (2 * num_attacks)) / (1 + z**2 / num_attacks)
+    spread = (
+        z
+        * np.sqrt(
+            success_rate * (1 - success_rate) / num_attacks
+            + z**2 / (4 * num_attacks**2)
+        )
+        / (1 + z**2 / num_attacks)
+    )
+
+    return GuessingEntropy(
+        mean_rank=mean_rank,
+        x_rank=(np.arange(nb_chunks, dtype=np.uint32) + 1) * step,
+        success_rate=success_rate,
+        mean_rank_ci=np.stack((mean_rank - margin, mean_rank + margin)),
+        success_rate_ci=np.stack((center - spread, center + spread)),
+    )
+
+
+class RankTracker:
+    """Online key rank for streaming acquisitions.
+
+    Every update adds the log-likelihoods of a new batch of predictions to the
+    per-guess accumulator in O(batch), the previous traces are never processed
+    again. The correct key is optional: without it the stop condition relies
+    on the posterior probability of the best guess.
+    """
+
+    def __init__(
+        self,
+        leakage_model: Callable,
+        guess_range: int = 256,
+        correct_key: Optional[int] = None,
+        model=None,
+        zero: str = "skip",
+    ):
+        """model: optional trained model to update directly from raw traces"""
+        assert correct_key is None or correct_key < guess_range
+        self.leakage_model = leakage_model
+        self.guess_range = guess_range
+        self.correct_key = correct_key
+        self.model = model
+        self.zero = zero
+        self.scores = np.zeros(guess_range)
+        self.nb_traces = 0
+        # One value per update
+        self.x_rank: list[int] = []
+        self.ranks: list[int] = []
+        self.best_guesses: list[int] = []
+
+    def update(self, predictions: np.ndarray, metadata: np.ndarray):
+        """Add a batch of predictions and their metadata"""
+        assert len(predictions) == len(metadata)
+        if len(predictions) == 0:
+            return
+        indices = hypotheses(self.leakage_model, metadata, self.guess_range)
+        self.scores += log_likelihoods(predictions, indices, np.log, self.zero).sum(
+            axis=0
+        )
+        self.nb_traces += len(predictions)
+
+        self.x_rank.append(self.nb_traces)
+        self.best_guesses.append(self.best_guess)
+        if self.correct_key is not None:
+            self.ranks.append(self.rank)
+
+    def update_traces(self, traces: np.ndarray, metadata: np.ndarray):
+        """Predict a batch of raw traces with the model and add them"""
+        assert self.model is not None
+        self.update(self.model.predict(traces, verbose=0), metadata)
+
+    @property
+    def rank(self) -> int:
+        """Current rank of the correct key"""
+        assert self.correct_key is not None
+        return int(ranks(self.scores, self.correct_key))
+
+    @property
+    def best_guess(self) -> int:
+        """Guess with the highest score so far"""
+        return int(np.argmax(self.scores))
+
+    def posterior(self) -> np.ndarray:
+        """Probability of every guess given the traces seen so far"""
+        probs = np.exp(self.scores - self.scores.max())
+        return probs / probs.sum()
+
+    def guessing_entropy(self) -> float:
+        """Expected number of guesses ranked before the key, averaged over the
+        posterior: sum_k P(k) * rank(k). It needs no correct key."""
+        guess_ranks = np.count_nonzero(
+            self.scores[np.newaxis, :] > self.scores[:, np.newaxis], axis=1
+        )
+        return float(np.dot(self.posterior(), guess_ranks))
+
+    def stop(self, rank: int = 0, patience: int = 1, confidence: float = 0.99) -> bool:
+        """Check if the acquisition can stop.
+
+        With a correct key: its rank stayed <= :rank: during the last
+        :patience: updates. Without it: the best guess did not change during
+        the last :patience: updates and its posterior is >= :confidence:.
+        """
+        if len(self.x_rank) < patience:
+            return False
+        if self.correct_key is not None:
+            return max(self.ranks[-patience:]) <= rank
+        last = self.best_guesses[-patience:]
+        return last.count(last[-1]) == patience and (
+            self.posterior()[self.best_guess] >= confidence
+        )
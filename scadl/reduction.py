@@ -0,0 +1,240 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from collections.abc import Callable
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+from sklearn.decomposition import IncrementalPCA
+
+from scadl.dataset import TraceDataset, iter_chunks
+from scadl.template import Template
+
+# Fitted attributes of IncrementalPCA saved by PCA.save
+_PCA_ATTRIBUTES = (
+    "components_",
+    "mean_",
+    "var_",
+    "explained_variance_",
+    "explained_variance_ratio_",
+    "singular_values_",
+    "noise_variance_",
+    "n_samples_seen_",
+)
+
+
+class PCA:
+    """Incremental PCA of long traces, fitted chunk by chunk with
+    sklearn.decomposition.IncrementalPCA.
+
+    The fitted PCA is a transform of a TraceDataset (see
+    scadl.dataset.TraceDataset) or of Match: the traces are projected batch by
+    batch, so the models take n_components inputs instead of the raw samples.
+    """
+
+    def __init__(self, n_components: int, whiten: bool = False):
+        self.n_components = n_components
+        self.whiten = whiten
+        self.pca = IncrementalPCA(n_components, whiten=whiten)
+        self._weights: Optional[tuple[np.ndarray, np.ndarray]] = None
+
+    def partial_fit(self, traces: np.ndarray) -> "PCA":
+        """Update the PCA with a chunk of at least n_components traces"""
+        self.pca.partial_fit(np.asarray(traces, dtype=np.float64))
+        self._weights = None
+        return self
+
+    def fit(
+        self, traces: Union[np.ndarray, TraceDataset], chunk_size: int = 10000
+    ) -> "PCA":
+        """Fit the PCA chunk by chunk (see scadl.dataset.iter_chunks), every
+        chunk holds at least n_components traces"""
+        assert chunk_size >= self.n_components
+        for chunk, _ in iter_chunks(
+            traces, chunk_size=chunk_size, minimum=self.n_components
+        ):
+            self.partial_fit(chunk)
+        return self
+
+    def _projection(self) -> tuple[np.ndarray, np.ndarray]:
+        """float32 (weights, offset) of transform(x) = x @ weights + offset"""
+        if self._weights is None:
+            weights = self.pca.components_.T
+            if self.whiten:
+                weights = weights / np.sqrt(self.pca.explained_variance_)
+            offset = -self.pca.mean_ @ weights
+            self._weights = weights.astype(np.float32), offset.astype(np.float32)
+        return self._weights
+
+    def transform(self, traces: np.ndarray) -> np.ndarray:
+        """Project a batch of traces on the components, in float32"""
+        weights, offset = self._projection()
+        return np.asarray(traces, dtype=np.float32) @ weights + offset
+
+    __call__ = transform
+
+    def save(self, path: Union[str, Path]):
+        """Save the fitted PCA as a .npz file"""
+        np.savez(
+            path,
+            n_components=self.n_components,
+            whiten=self.whiten,
+            **{name: getattr(self.pca, name) for name in _PCA_ATTRIBUTES},
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "PCA":
+        """Load a PCA saved with :save:, it can be updated with partial_fit"""
+        with np.load(path) as file:
+            pca = cls(int(file["n_components"]), bool(file["whiten"]))
+            for name in _PCA_ATTRIBUTES:
+                value = file[name]
+                setattr(pca.pca, name, value if value.ndim else value.item())
+        pca.pca.n_components_ = pca.pca.components_.shape[0]
+        pca.pca.n_features_in_ = pca.pca.components_.shape[1]
+        return pca
+
+
+class LDA:
+    """Streaming linear discriminant analysis with the classes given by the
+    leakage model, as for the profiling labels.
+
+    The per-class sums and the scatter matrix are accumulated chunk by chunk
+    with scadl.template.Template, the projection maximizes the between-class
+    scatter relative to the pooled within-class scatter. The scatter is
+    samples x samples: on long traces, select the POIs with :samples: or
+    reduce the traces with a PCA first (:pca:).
+    """
+
+    def __init__(
+        self,
+        leakage_model: Callable,
+        n_components: int,
+        num_classes: int = 256,
+        samples: Optional[Union[slice, np.ndarray]] = None,
+        pca: Optional[PCA] = None,
+        regularization: float = 1e-6,
+    ):
+        """pca: a fitted PCA applied to the traces before the LDA.
+        regularization: added to the diagonal of the within-class covariance,
+        relative to its mean variance."""
+        assert n_components >= 1
+        self.leakage_model = leakage_model
+        self.n_components = n_components
+        self.num_classes = num_classes
+        self.pca = pca
+        self.regularization = regularization
+        self.template = Template(leakage_model, num_classes, samples)
+        self.weights: Optional[np.ndarray] = None
+        self.offset: Optional[np.ndarray] = None
+
+    def _input(self, traces: np.ndarray) -> np.ndarray:
+        return traces if self.pca is None else self.pca.transform(traces)
+
+    def partial_fit(self, traces: np.ndarray, metadata: np.ndarray) -> "LDA":
+        """Update the class statistics with a chunk of profiling traces"""
+        self.template.partial_fit(self._input(traces), metadata)
+        self.weights = None
+        return self
+
+    def fit(
+        self,
+        traces: Union[np.ndarray, TraceDataset],
+        metadata: Optional[np.ndarray] = None,
+        chunk_size: int = 10000,
+    ) -> "LDA":
+        """Fit the LDA chunk by chunk (see scadl.dataset.iter_chunks)"""
+        for chunk in iter_chunks(traces, metadata, chunk_size):
+            self.partial_fit(*chunk)
+        self._projection()
+        return self
+
+    def _projection(self):
+        """Solve the generalized eigenproblem Sb w = l Sw w by whitening Sw"""
+        template = self.template
+        present = template.counts > 0
+        assert np.count_nonzero(present) >= 2
+        counts = template.counts[present]
+        means = template.means()[present]
+        mean = counts @ means / counts.sum()
+
+        within = template.covariance()
+        within += (
+            np.eye(len(within)) * self.regularization * np.trace(within) / len(within)
+        )
+        centered = (means - mean) * np.sqrt(counts / counts.sum())[:, np.newaxis]
+        cholesky = np.linalg.cholesky(within)
+        # L^-1 Sb L^-T, Sb = centered^T centered
+        whitened = np.linalg.solve(cholesky, centered.T)
+        values, vectors = np.linalg.eigh(whitened @ whitened.T)
+        order = np.argsort(values)[::-1][: self.n_components]
+        weights = np.linalg.solve(cholesky.T, vectors[:, order])
+        self.weights = weights.astype(np.float32)
+        self.offset = (-mean @ weights).astype(np.float32)
+
+    def transform(self, traces: np.ndarray) -> np.ndarray:
+        """Project a batch of traces on the discriminant axes, in float32"""
+        if self.weights is None:
+            self._projection()
+        traces = np.asarray(self._input(traces), dtype=np.float32)
+        if self.template.samples is not None:
+            traces = traces[:, self.template.samples]
+        return traces @ self.weights + self.offset
+
+    __call__ = transform
+
+    def save(self, path: Union[str, Path]):
+        """Save the projection as a .npz file, the leakage model and the PCA
+        are not saved"""
+        if self.weights is None:
+            self._projection()
+        samples = self.template.samples
+        if isinstance(samples, slice):
+            assert samples.stop is not None
+            samples = np.arange(samples.start or 0, samples.stop, samples.step or 1)
+        np.savez(
+            path,
+            n_components=self.n_components,
+            num_classes=self.num_classes,
+            samples=np.array([] if samples is None else samples, dtype=np.intp),
+            weights=self.weights,
+            offset=self.offset,
+        )
+
+    @classmethod
+    def load(
+        cls,
+        path: Union[str, Path],
+        leakage_model: Optional[Callable] = None,
+        pca: Optional[PCA] = None,
+    ) -> "LDA":
+        """Load an LDA saved with :save:, with the PCA it was fitted after"""
+        with np.load(path) as file:
+            samples = file["samples"]
+            lda = cls(
+                leakage_model,
+                int(file["n_components"]),
+                int(file["num_classes"]),
+                samples if len(samples) else None,
+                pca,
+            )
+            lda.weights = file["weights"]
+            lda.offset = file["offset"]
+        return lda
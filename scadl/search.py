@@ -0,0 +1,276 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+import itertools
+import json
+import math
+import random
+import tempfile
+import time
+from collections.abc import Callable, Sequence
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import keras
+import numpy as np
+from keras.models import Model
+
+from scadl._pool import process_pool, worker
+from scadl.dataset import TraceDataset, TraceSequence
+from scadl.rank import guessing_entropy, log_likelihood_matrix
+from scadl.tools import apply_leakage_model
+
+Space = dict[str, Sequence[Any]]
+Data = tuple[Union[np.ndarray, str, Path], Union[np.ndarray, str, Path]]
+
+
+def configurations(
+    space: Space, nb_trials: Optional[int] = None, seed: Optional[int] = None
+) -> list[dict[str, Any]]:
+    """All the configurations of the grid :space:, or :nb_trials: of them drawn
+    at random without replacement"""
+    names = list(space)
+    grid = [dict(zip(names, values)) for values in itertools.product(*space.values())]
+    if nb_trials is None or nb_trials >= len(grid):
+        return grid
+    return random.Random(seed).sample(grid, nb_trials)
+
+
+def _dataset(name: str) -> TraceDataset:
+    """Train or attack TraceDataset of the worker, memory-mapped once from
+    the (traces, metadata) paths of the worker state"""
+    if not isinstance(worker[name], TraceDataset):
+        worker[name] = TraceDataset.from_numpy(*worker[name])
+    return worker[name]
+
+
+def _run_rung(
+    trial: int,
+    config: dict[str, Any],
+    checkpoint: str,
+    initial_epoch: int,
+    epochs: int,
+    train_indices: np.ndarray,
+    validation_indices: np.ndarray,
+    num_classes: int,
+    batch_size: int,
+    guess_range: int,
+    correct_key: int,
+    step: int,
+    num_attacks: int,
+    nb_traces: Optional[int],
+    seed: Optional[int],
+) -> dict[str, Any]:
+    """Train a trial for one rung inside a pool worker and evaluate its GE"""
+    start = time.perf_counter()
+    leakage_model = worker["leakage_model"]
+    if initial_epoch == 0:
+        model = worker["model_builder"](**config)
+    else:
+        model = keras.models.load_model(checkpoint)
+
+    def labels(metadata: np.ndarray) -> np.ndarray:
+        y = apply_leakage_model(leakage_model, metadata)
+        return keras.utils.to_categorical(y, num_classes)
+
+    history = model.fit(
+        TraceSequence(
+            _dataset("train"), labels, batch_size, train_indices, shuffle=True
+        ),
+        validation_data=TraceSequence(
+            _dataset("train"), labels, batch_size, validation_indices
+        ),
+        initial_epoch=initial_epoch,
+        epochs=initial_epoch + epochs,
+        verbose=0,
+    )
+    model.save(checkpoint)
+
+    attack = _dataset("attack")
+    predictions = model.predict(TraceSequence(attack, batch_size=batch_size), verbose=0)
+    result = guessing_entropy(
+        log_likelihood_matrix(predictions, leakage_model, attack.metadata, guess_range),
+        correct_key,
+        step,
+        num_attacks,
+        nb_traces,
+        seed=seed,
+    )
+    solved = np.flatnonzero(result.mean_rank == 0)
+    return {
+        "trial": trial,
+        "config": config,
+        "epochs": initial_epoch + epochs,
+        "ge": float(result.mean_rank[-1]),
+        "ge_area": float(result.mean_rank.mean()),
+        "traces_to_ge0": int(result.x_rank[solved[0]]) if len(solved) else None,
+        "history": {
+            metric: [float(v) for v in values]
+            for metric, values in history.history.items()
+        },
+        "seconds": time.perf_counter() - start,
+    }
+
+
+def _score(result: dict[str, Any]) -> tuple[float, float]:
+    """The lower the better: final GE, then the area under the GE curve"""
+    return result["ge"], result["ge_area"]
+
+
+def _as_files(data: Data, directory: Path, name: str) -> tuple[str, str]:
+    """Paths of the (traces, metadata) .npy files, written once if needed"""
+    if isinstance(data[0], (str, Path)):
+        return str(data[0]), str(data[1])
+    paths = (str(directory / f"{name}_traces.npy"), str(directory / f"{name}_meta.npy"))
+    for path, array in zip(paths, data):
+        np.save(path, array)
+    return paths
+
+
+class Search:
+    """Hyperparameter and architecture search of profiling models.
+
+    model_builder(**config) returns a fresh compiled model for a configuration
+    of :space:, e.g. {"lr": [1e-3, 1e-4], "filters": [8, 16]}. It must be
+    picklable (a module-level function). The trials are trained across a
+    process pool by successive halving: all of them are trained for
+    :rung_epochs:, evaluated with the guessing entropy on the attack traces,
+    and only the best (1 - :drop_fraction:) are trained for the next rung.
+    The last one left is trained until :max_epochs:.
+    Every evaluation is appended to :results: as one JSON line.
+
+    The traces are memory-mapped .npy files opened once by every worker, so
+    they are shared through the page cache instead of copied into each
+    process.
+    """
+
+    def __init__(
+        self,
+        model_builder: Callable[..., Model],
+        leakage_model: Callable,
+        space: Space,
+        results: Union[str, Path],
+        rung_epochs: int = 5,
+        drop_fraction: float = 0.5,
+        max_epochs: int = 50,
+    ):
+        assert rung_epochs >= 1
+        assert 0 < drop_fraction < 1
+        self.model_builder = model_builder
+        self.leakage_model = leakage_model
+        self.space = space
+        self.results = Path(results)
+        self.rung_epochs = rung_epochs
+        self.drop_fraction = drop_fraction
+        self.max_epochs = max_epochs
+        self.best: Optional[dict[str, Any]] = None
+
+    def run(
+        self,
+        train: Data,
+        attack: Data,
+        correct_key: int,
+        num_classes: int = 256,
+        guess_range: int = 256,
+        nb_trials: Optional[int] = None,
+        batch_size: int = 100,
+        validation_split: float = 0.1,
+        step: int = 10,
+        num_attacks: int = 20,
+        nb_traces: Optional[int] = None,
+        workers: Optional[int] = None,
+        threads: int = 1,
+        checkpoints: Optional[Union[str, Path]] = None,
+        seed: Optional[int] = None,
+    ) -> list[dict[str, Any]]:
+        """Run the search and return the last evaluation of every trial, best
+        first.
+
+        train, attack: (traces, metadata) arrays, or the paths of their .npy
+        files which are then used in place (e.g. the CW traces.npy).
+        correct_key: key byte of the attack traces.
+        num_attacks, nb_traces, step: parameters of the guessing entropy.
+        checkpoints: directory of the models between two rungs, a temporary
+        one by default. The best model is checkpoints/trial_<best>.keras.
+        """
+        trials = configurations(self.space, nb_trials, seed)
+        with tempfile.TemporaryDirectory() as temporary:
+            directory = Path(checkpoints or temporary)
+            directory.mkdir(parents=True, exist_ok=True)
+            train_paths = _as_files(train, directory, "train")
+            attack_paths = _as_files(attack, directory, "attack")
+
+            nb_train = len(np.load(train_paths[1], mmap_mode="r"))
+            indices = np.random.default_rng(seed).permutation(nb_train)
+            split = math.floor(nb_train * (1 - validation_split))
+
+            latest: dict[int, dict[str, Any]] = {}
+            survivors = list(range(len(trials)))
+            epoch = 0
+            with process_pool(
+                workers,
+                {
+                    "model_builder": self.model_builder,
+                    "leakage_model": self.leakage_model,
+                    "train": train_paths,
+                    "attack": attack_paths,
+                },
+                threads,
+            ) as pool:
+                while epoch < self.max_epochs:
+                    epochs = min(self.rung_epochs, self.max_epochs - epoch)
+                    futures = [
+                        pool.submit(
+                            _run_rung,
+                            trial,
+                            trials[trial],
+                            str(directory / f"trial_{trial}.keras"),
+                            epoch,
+                            epochs,
+                            indices[:split],
+                            indices[split:],
+                            num_classes,
+                            batch_size,
+                            guess_range,
+                            correct_key,
+                            step,
+                            num_attacks,
+                            nb_traces,
+                            seed,
+                        )
+                        for trial in survivors
+                    ]
+                    for future in futures:
+                        result = future.result()
+                        latest[result["trial"]] = result
+                        self._save(result)
+                    epoch += epochs
+
+                    survivors.sort(key=lambda trial: _score(latest[trial]))
+                    keep = max(1, math.ceil(len(survivors) * (1 - self.drop_fraction)))
+                    survivors = survivors[:keep]
+
+        ranking = sorted(latest.values(), key=_score)
+        self.best = ranking[0]
+        return ranking
+
+    def _save(self, result: dict[str, Any]):
+        """Append :result: to the results file"""
+        with open(self.results, "a", encoding="utf-8") as file:
+            file.write(json.dumps(result) + "\n")
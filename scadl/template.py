@@ -0,0 +1,195 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+from collections.abc import Callable
+from pathlib import Path
+from typing import Optional, Union
+
+import numpy as np
+
+from scadl.dataset import TraceDataset, iter_chunks
+from scadl.rank import accumulated_ranks, hypotheses
+from scadl.tools import apply_leakage_model
+
+
+class Template:
+    """Gaussian template attack with a pooled covariance.
+
+    It uses the same leakage model as Profile/Match: leakage_model(metadata)
+    gives the profiling classes and leakage_model(data, guess) the class of
+    every guess in the attack. The per-class means and the pooled covariance
+    of the POIs are accumulated in one streaming pass. With a covariance
+    shared by all classes, the log-likelihood of a class is linear in the
+    trace (LDA), so matching is a single (traces x POIs) (POIs x classes)
+    product.
+    """
+
+    def __init__(
+        self,
+        leakage_model: Callable,
+        num_classes: int = 256,
+        samples: Optional[Union[slice, np.ndarray]] = None,
+    ):
+        """samples: optional slice or index array of the POIs, e.g. from
+        scadl.poi.poi_indices. Keep it small: the covariance is POIs x POIs.
+        """
+        self.leakage_model = leakage_model
+        self.num_classes = num_classes
+        self.samples = samples
+        self.counts = np.zeros(num_classes, dtype=np.int64)
+        self.sums: Optional[np.ndarray] = None
+        self.scatter: Optional[np.ndarray] = None
+        self.weights: Optional[np.ndarray] = None
+        self.bias: Optional[np.ndarray] = None
+
+    def _select(self, traces: np.ndarray) -> np.ndarray:
+        traces = np.asarray(traces, dtype=np.float64)
+        if self.samples is not None:
+            traces = traces[:, self.samples]
+        return traces
+
+    def partial_fit(self, traces: np.ndarray, metadata: np.ndarray) -> "Template":
+        """Update the statistics with a chunk of profiling traces"""
+        traces = self._select(traces)
+        labels = apply_leakage_model(self.leakage_model, metadata).astype(np.intp)
+        assert len(traces) == len(labels)
+        assert labels.min(initial=0) >= 0 and labels.max(initial=0) < self.num_classes
+        if self.sums is None:
+            self.sums = np.zeros((self.num_classes, traces.shape[1]))
+            self.scatter = np.zeros((traces.shape[1], traces.shape[1]))
+
+        self.counts += np.bincount(labels, minlength=self.num_classes)
+        np.add.at(self.sums, labels, traces)
+        self.scatter += traces.T @ traces
+        self.weights = None
+        return self
+
+    def fit(
+        self,
+        traces: Union[np.ndarray, TraceDataset],
+        metadata: Optional[np.ndarray] = None,
+        chunk_size: int = 10000,
+    ) -> "Template":
+        """Build the templates chunk by chunk (see scadl.dataset.iter_chunks)"""
+        for chunk in iter_chunks(traces, metadata, chunk_size):
+            self.partial_fit(*chunk)
+        return self
+
+    def means(self) -> np.ndarray:
+        """Per-class means, NaN for the classes never seen"""
+        with np.errstate(divide="ignore", invalid="ignore"):
+            return self.sums / self.counts[:, np.newaxis]
+
+    def covariance(self) -> np.ndarray:
+        """Pooled within-class covariance"""
+        present = self.counts > 0
+        means = self.means()[present]
+        within = self.scatter - (means.T * self.counts[present]) @ means
+        return within / (self.counts.sum() - np.count_nonzero(present))
+
+    def _projection(self):
+        """Precompute the LDA weights and biases from the Cholesky factor"""
+        present = self.counts > 0
+        assert np.count_nonzero(present) >= 2
+        means = self.means()[present]
+        cholesky = np.linalg.cholesky(self.covariance())
+        # Whitened means: W mu with W = L^-1, so Sigma^-1 mu = W^T W mu
+        whitened = np.linalg.solve(cholesky, means.T)
+        self.weights = np.zeros((self.sums.shape[1], self.num_classes))
+        self.weights[:, present] = np.linalg.solve(cholesky.T, whitened)
+        # Absent classes get the lowest score of each trace, see log_likelihood
+        self.bias = np.full(self.num_classes, np.nan)
+        self.bias[present] = -0.5 * np.square(whitened).sum(axis=0)
+
+    def log_likelihood(self, traces: np.ndarray) -> np.ndarray:
+        """(N, num_classes) log-likelihood of every class, up to a constant of
+        each trace shared by all the classes"""
+        if self.weights is None:
+            self._projection()
+        scores = self._select(traces) @ self.weights + self.bias
+        absent = np.isnan(self.bias)
+        if absent.any():
+            scores[:, absent] = scores[:, ~absent].min(axis=1, keepdims=True)
+        return scores
+
+    def predict(self, traces: np.ndarray) -> np.ndarray:
+        """Posterior probabilities of the classes with a uniform prior, in the
+        format of model.predict"""
+        scores = self.log_likelihood(traces)
+        scores = np.exp(scores - scores.max(axis=1, keepdims=True))
+        return (scores / scores.sum(axis=1, keepdims=True)).astype(np.float32)
+
+    def log_likelihood_matrix(
+        self, traces: np.ndarray, metadata: np.ndarray, guess_range: int
+    ) -> np.ndarray:
+        """(N, guess_range) per-trace log-likelihood of every guess, e.g. for
+        scadl.rank.guessing_entropy"""
+        scores = self.log_likelihood(traces)
+        indices = hypotheses(self.leakage_model, metadata, guess_range)
+        return scores[np.arange(len(scores))[:, np.newaxis], indices]
+
+    def match(
+        self,
+        x_test: np.ndarray,
+        metadata: np.ndarray,
+        guess_range: int,
+        correct_key: int,
+        step: int,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Rank of the correct key every :step: traces, as Match.match. The
+        log-likelihoods are summed block by block, without going through
+        probabilities which underflow for well separated classes."""
+        assert len(x_test) > 0 and len(x_test) == len(metadata)
+        assert correct_key < guess_range
+        assert step >= 1
+
+        def block_scores(index: slice) -> np.ndarray:
+            return self.log_likelihood_matrix(
+                x_test[index], metadata[index], guess_range
+            )
+
+        return accumulated_ranks(
+            block_scores, len(x_test), guess_range, correct_key, step
+        )
+
+    def save(self, path: Union[str, Path]):
+        """Save the statistics as a .npz file, the leakage model is not saved"""
+        samples = self.samples
+        if isinstance(samples, slice):
+            assert samples.stop is not None
+            samples = np.arange(samples.start or 0, samples.stop, samples.step or 1)
+        np.savez(
+            path,
+            num_classes=self.num_classes,
+            samples=np.array([] if samples is None else samples, dtype=np.intp),
+            counts=self.counts,
+            sums=self.sums,
+            scatter=self.scatter,
+        )
+
+    @classmethod
+    def load(cls, path: Union[str, Path], leakage_model: Callable) -> "Template":
+        """Load templates saved with :save:"""
+        with np.load(path) as file:
+            samples = file["samples"] if len(file["samples"]) else None
+            template = cls(leakage_model, int(file["num_classes"]), samples)
+            template.counts = file["counts"]
+            template.sums = file["sums"]
+            template.scatter = file["scatter"]
+        return template
@@ -17,6 +17,9 @@
 # Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
 
 
+from collections.abc import Callable
+from typing import Optional, Union
+
 import numpy as np
 
 # fmt: off
@@ -62,6 +65,10 @@ inv_sbox = np.array([
 # fmt: on
 
 
+# Hamming weight of every byte value
+hw = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
+
+
 def is_valid(data: np.ndarray) -> bool:
     """Check if all elements of :data: are valid (real values without nan)."""
 
@@ -111,4 +118,108 @@ def gen_labels(leakage_model, metadata: np.ndarray, key_byte: int) -> np.ndarray
     metadata,
     key_byte: oreder of attacked key.
     It returns the labels used for DL"""
-    return np.array([leakage_model(m, key_byte=key_byte) for m in metadata])
+    return apply_leakage_model(leakage_model, metadata, key_byte=key_byte)
+
+
+def apply_leakage_model(
+    leakage_model: Callable, metadata: np.ndarray, *args, **kwargs
+) -> np.ndarray:
+    """Return leakage_model(m, *args, **kwargs) for every m of :metadata:.
+
+    Vectorized leakage models (see :vectorized: and
+    scadl.leakage_compiler.tabulated) are called once on the whole metadata
+    array.
+    """
+    if is_vectorized(leakage_model):
+        return np.asarray(leakage_model(metadata, *args, **kwargs))
+    return np.array([leakage_model(m, *args, **kwargs) for m in metadata])
+
+
+def vectorized(leakage_model: Callable) -> Callable:
+    """Mark :leakage_model: as vectorized.
+
+    A vectorized leakage model accepts the whole metadata array of shape (N,)
+    and an array of guesses of shape (G,) and returns the index matrix of
+    shape (N, G) in one call, i.e. leakage_model(metadata, guesses)[n, g]
+    equals the scalar leakage_model(metadata[n], guesses[g]).
+    """
+    leakage_model.vectorized = True
+    return leakage_model
+
+
+def is_vectorized(leakage_model: Callable) -> bool:
+    """Check if :leakage_model: has been marked with :vectorized:."""
+    return getattr(leakage_model, "vectorized", False)
+
+
+class SboxLeakage:
+    """Array-native leakage model of the AES first round sbox output.
+
+    It computes sbox[plaintext ^ key] for a structured metadata array holding
+    "plaintext" and "key" fields (ASCAD and CW layouts), optionally masked
+    with a byte of :mask_field: and reduced by :output::
+    - "identity": the sbox output,
+    - "hw": its Hamming weight,
+    - "hd": Hamming distance between the sbox input and output,
+    - "lsb"/"msb": its least/most significant bit.
+
+    key_byte selects the attacked byte, or a list of them; None means all of
+    them at once.
+    mask_byte selects the byte of :mask_field:, the attacked byte by default.
+
+    It is vectorized: model(metadata) returns the labels using the key of the
+    metadata, model(metadata, guesses) uses the guesses instead and returns
+    the (N, G) hypothesis matrix when guesses has shape (G,). It also works on
+    a single metadata record like the scalar leakage models.
+    """
+
+    vectorized = True
+    outputs = ("identity", "hw", "hd", "lsb", "msb")
+
+    def __init__(
+        self,
+        key_byte: Optional[int] = None,
+        output: str = "identity",
+        mask_field: Optional[str] = None,
+        mask_byte: Optional[int] = None,
+    ):
+        assert output in self.outputs
+        self.key_byte = key_byte
+        self.output = output
+        self.mask_field = mask_field
+        self.mask_byte = mask_byte
+
+    def __call__(
+        self,
+        metadata: np.ndarray,
+        guess: Optional[Union[int, np.ndarray]] = None,
+        key_byte: Optional[int] = None,
+    ) -> np.ndarray:
+        byte = self.key_byte if key_byte is None else key_byte
+        # The mask byte follows the attacked byte unless it is configured
+        mask_byte = byte if self.mask_byte is None else self.mask_byte
+
+        def field(name: str, index: Optional[int]) -> np.ndarray:
+            value = np.asarray(metadata[name])
+            if index is not None:
+                value = value[..., index]
+            if guess is not None and np.ndim(guess) == 1:
+                # One column per guess
+                value = value[..., np.newaxis]
+            return value
+
+        key = field("key", byte) if guess is None else np.asarray(guess)
+        state = field("plaintext", byte) ^ key
+        value = sbox[state]
+        if self.mask_field is not None:
+            value = value ^ field(self.mask_field, mask_byte)
+
+        if self.output == "hw":
+            return hw[value]
+        if self.output == "hd":
+            return hw[value ^ state]
+        if self.output == "lsb":
+            return value & 1
+        if self.output == "msb":
+            return value >> 7
+        return value
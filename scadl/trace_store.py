@@ -0,0 +1,433 @@
+# This file is part of scadl
+#
+# scadl is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Lesser General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Lesser General Public License for more details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+#
+#
+# Copyright 2024 Karim ABDELLATIF, PhD, Ledger - karim.abdellatif@ledger.fr
+
+
+import json
+import os
+from collections import OrderedDict
+from collections.abc import Callable, Iterator
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Optional, Union
+
+import h5py
+import numpy as np
+
+from scadl.dataset import TraceDataset, iter_chunks
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+MANIFEST = "manifest.json"
+VERSION = 1
+
+# Directory of the chunks of every layout, the metadata is always trace-major
+LAYOUTS = {"trace": "traces", "sample": "samples"}
+
+# Compressed chunks are made of blocks of traces compressed separately, so a
+# random read (e.g. a shuffled batch) only decompresses the blocks it needs
+BLOCK_TRACES = 64
+
+# Number of decompressed blocks kept in memory by a ChunkedArray
+CACHED_BLOCKS = 256
+
+
+@contextmanager
+def _locked(path: Path):
+    """Exclusive lock of the store, writers append one at a time"""
+    with open(path / "lock", "a+b") as file:
+        if fcntl is not None:
+            fcntl.flock(file, fcntl.LOCK_EX)
+        else:
+            file.seek(0)
+            msvcrt.locking(file.fileno(), msvcrt.LK_LOCK, 1)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(file, fcntl.LOCK_UN)
+            else:
+                file.seek(0)
+                msvcrt.locking(file.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+def _write_json(path: Path, content: dict[str, Any]):
+    """Write aside and rename, readers see the old or the new file entirely"""
+    temporary = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(temporary, "w", encoding="utf-8") as file:
+        json.dump(content, file, indent=1)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
+
+
+def _save_chunk(
+    path: Path,
+    array: np.ndarray,
+    compression: bool,
+    sample_major: bool = False,
+    block_size: int = BLOCK_TRACES,
+) -> str:
+    """Save one immutable chunk, return its file name. Compressed chunks are
+    saved as blocks of :block_size: traces, along the last axis if
+    :sample_major:"""
+    if compression:
+        name = path.with_suffix(".npz")
+        count = array.shape[-1] if sample_major else len(array)
+        blocks = {}
+        for block, start in enumerate(range(0, count, block_size)):
+            index = slice(start, start + block_size)
+            blocks[str(block)] = array[..., index] if sample_major else array[index]
+        np.savez_compressed(name, **blocks)
+    else:
+        name = path.with_suffix(".npy")
+        np.save(name, array)
+    return name.name
+
+
+class ChunkedArray:
+    """Read-only array over the chunks of a snapshot, e.g. the traces given
+    to a TraceDataset.
+
+    It supports len, shape, dtype and the indexing used by scadl: an int, a
+    slice or an index array of traces, optionally followed by the samples to
+    keep. With the "sample" layout, the chunks are stored sample-major, so
+    reading a few samples (POIs) of many traces reads contiguous data.
+    The rows of a read are grouped by chunk and, for compressed chunks, by
+    block: every block needed is decompressed once per read.
+    """
+
+    def __init__(
+        self,
+        files: list[Path],
+        counts: list[int],
+        shape: tuple[int, ...],
+        dtype: np.dtype,
+        sample_major: bool = False,
+        block_size: int = BLOCK_TRACES,
+    ):
+        self.files = files
+        self.offsets = np.concatenate([[0], np.cumsum(counts, dtype=np.int64)])
+        self.shape = (int(self.offsets[-1]),) + tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.sample_major = sample_major
+        self.block_size = block_size
+        self._cache: OrderedDict = OrderedDict()
+        # Opened .npz files, their zip directory is read once
+        self._files: dict = {}
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    @property
+    def ndim(self) -> int:
+        return len(self.shape)
+
+    def _block(self, chunk: int, block: int) -> np.ndarray:
+        """Decompressed block of a compressed chunk"""
+        key = (chunk, block)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+        else:
+            if chunk not in self._files:
+                self._files[chunk] = np.load(self.files[chunk])
+            self._cache[key] = self._files[chunk][str(block)]
+            if len(self._cache) > CACHED_BLOCKS:
+                self._cache.popitem(last=False)
+        return self._cache[key]
+
+    def _read(self, chunk: int, local: np.ndarray, columns: tuple) -> np.ndarray:
+        """Rows :local: of a chunk, trace-major, with the :columns: kept"""
+        path = self.files[chunk]
+        if path.suffix == ".npy":
+            data = np.load(path, mmap_mode="r")
+            if not self.sample_major:
+                return np.asarray(data[local])[(slice(None),) + columns]
+            # (samples, traces): select the samples first
+            if columns:
+                data = data[columns[0]]
+            return np.asarray(data[..., local]).T
+
+        blocks = local // self.block_size
+        result = None
+        for block in np.unique(blocks):
+            selected = np.flatnonzero(blocks == block)
+            rows = local[selected] - block * self.block_size
+            data = self._block(chunk, int(block))
+            if self.sample_major:
+                if columns:
+                    data = data[columns[0]]
+                data = data[..., rows].T
+            else:
+                data = data[rows][(slice(None),) + columns]
+            if result is None:
+                result = np.empty((len(local),) + data.shape[1:], data.dtype)
+            result[selected] = data
+        return result
+
+    def _rows(self, rows) -> np.ndarray:
+        """Trace indices of an int, a slice or an index array, in O(rows)"""
+        if isinstance(rows, slice):
+            return np.arange(*rows.indices(len(self)))
+        rows = np.asarray(rows)
+        if rows.dtype == bool:
+            assert rows.shape == (len(self),)
+            return np.flatnonzero(rows)
+        rows = np.atleast_1d(rows).astype(np.int64)
+        if rows.size and (rows.min() < -len(self) or rows.max() >= len(self)):
+            raise IndexError(f"index out of range for {len(self)} traces")
+        return np.where(rows < 0, rows + len(self), rows)
+
+    def __getitem__(self, key) -> np.ndarray:
+        if isinstance(key, tuple):
+            rows, columns = key[0], key[1:]
+        else:
+            rows, columns = key, ()
+        squeeze = isinstance(rows, (int, np.integer))
+        rows = self._rows(rows)
+
+        chunks = np.searchsorted(self.offsets, rows, side="right") - 1
+        result = np.empty((len(rows),) + self.shape[1:], dtype=self.dtype)
+        if columns:
+            result = result[(slice(None),) + columns]
+        for chunk in np.unique(chunks):
+            selected = np.flatnonzero(chunks == chunk)
+            local = rows[selected] - self.offsets[chunk]
+            result[selected] = self._read(int(chunk), local, columns)
+        return result[0] if squeeze else result
+
+    def __getstate__(self) -> dict:
+        # Opened files and cached blocks are not sent to other processes
+        return {**self.__dict__, "_cache": OrderedDict(), "_files": {}}
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+
+class Snapshot:
+    """Consistent view of a store: the chunks listed in the manifest when it
+    was read. Chunks are never modified, so later appends do not change it."""
+
+    def __init__(self, path: Path, manifest: dict[str, Any]):
+        self.path = path
+        self.manifest = manifest
+
+    def __len__(self) -> int:
+        return self.manifest["nb_traces"]
+
+    def _array(self, directory: str, field: str, sample_major: bool = False):
+        chunks = self.manifest["chunks"]
+        return ChunkedArray(
+            [self.path / directory / chunk[field] for chunk in chunks],
+            [chunk["traces"] for chunk in chunks],
+            tuple(self.manifest[f"{field}_shape"]),
+            np.lib.format.descr_to_dtype(_descr(self.manifest[f"{field}_dtype"])),
+            sample_major,
+            self.manifest["block_size"],
+        )
+
+    def traces(self, layout: str = "trace") -> ChunkedArray:
+        """The (N, samples) traces read from the chunks of :layout:"""
+        assert layout in self.manifest["layouts"]
+        return self._array(LAYOUTS[layout], layout, layout == "sample")
+
+    @property
+    def metadata(self) -> ChunkedArray:
+        return self._array("metadata", "metadata")
+
+    def dataset(
+        self,
+        samples: Optional[Union[slice, np.ndarray]] = None,
+        transform: Optional[Callable[[np.ndarray], np.ndarray]] = None,
+        layout: str = "trace",
+    ) -> TraceDataset:
+        """TraceDataset of the snapshot, to train or attack from the store"""
+        return TraceDataset(self.traces(layout), self.metadata, samples, transform)
+
+
+def _descr(descr):
+    """dtype description back from JSON, where tuples became lists"""
+    if isinstance(descr, str):
+        return descr
+    fields = []
+    for name, dtype, *shape in descr:
+        fields.append((name, _descr(dtype)) + tuple(tuple(item) for item in shape))
+    return fields
+
+
+class TraceStore:
+    """Append-only store of traces and their structured metadata.
+
+    A store is a directory of immutable chunks of at most :chunk_size:
+    traces, listed by manifest.json:
+    - traces/: trace-major chunks (N, samples), for training and attacks,
+    - samples/: the same chunks sample-major (samples, N) if the "sample"
+      layout is enabled, for per-sample statistics and POI reads,
+    - metadata/: the metadata of every chunk (the sidecar).
+    The chunks are .npy files (memory-mapped) or compressed .npz files of
+    :block_size: trace blocks, decompressed separately on random reads.
+    Writers append under a file lock and publish the new chunks by replacing
+    the manifest atomically, so readers always see a consistent snapshot.
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        """Open an existing store, see create"""
+        self.path = Path(path)
+        assert (self.path / MANIFEST).exists()
+
+    @classmethod
+    def create(
+        cls,
+        path: Union[str, Path],
+        chunk_size: int = 10000,
+        compression: bool = False,
+        layouts: tuple[str, ...] = ("trace",),
+        block_size: int = BLOCK_TRACES,
+    ) -> "TraceStore":
+        """Create an empty store, the dtypes are set by the first append.
+        block_size: traces per separately compressed block of a chunk"""
+        assert chunk_size >= 1 and block_size >= 1
+        assert layouts and all(layout in LAYOUTS for layout in layouts)
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        assert not (path / MANIFEST).exists()
+        for directory in [LAYOUTS[layout] for layout in layouts] + ["metadata"]:
+            (path / directory).mkdir(exist_ok=True)
+        _write_json(
+            path / MANIFEST,
+            {
+                "version": VERSION,
+                "chunk_size": chunk_size,
+                "compression": compression,
+                "block_size": block_size,
+                "layouts": list(layouts),
+                "nb_traces": 0,
+                "chunks": [],
+            },
+        )
+        return cls(path)
+
+    def manifest(self) -> dict[str, Any]:
+        with open(self.path / MANIFEST, encoding="utf-8") as file:
+            return json.load(file)
+
+    def __len__(self) -> int:
+        return self.manifest()["nb_traces"]
+
+    def snapshot(self) -> Snapshot:
+        """The traces appended so far, unaffected by later appends"""
+        return Snapshot(self.path, self.manifest())
+
+    def append(self, traces: np.ndarray, metadata: np.ndarray):
+        """Append traces and their metadata as new chunks"""
+        traces = np.asarray(traces)
+        metadata = np.asarray(metadata)
+        assert len(traces) == len(metadata)
+        if len(traces) == 0:
+            return
+
+        with _locked(self.path):
+            manifest = self.manifest()
+            fields = {
+                "trace_dtype": np.lib.format.dtype_to_descr(traces.dtype),
+                "trace_shape": list(traces.shape[1:]),
+                "metadata_dtype": np.lib.format.dtype_to_descr(metadata.dtype),
+                "metadata_shape": list(metadata.shape[1:]),
+            }
+            if manifest["nb_traces"] == 0:
+                manifest.update(fields)
+                manifest["sample_dtype"] = fields["trace_dtype"]
+                manifest["sample_shape"] = fields["trace_shape"]
+            else:
+                # JSON round trip, to compare with the manifest
+                fields = json.loads(json.dumps(fields))
+                assert all(manifest[key] == value for key, value in fields.items())
+
+            options = {
+                "compression": manifest["compression"],
+                "block_size": manifest["block_size"],
+            }
+            for start in range(0, len(traces), manifest["chunk_size"]):
+                stop = start + manifest["chunk_size"]
+                name = f"{len(manifest['chunks']):06d}"
+                chunk = {"traces": len(traces[start:stop])}
+                for layout in manifest["layouts"]:
+                    data = traces[start:stop]
+                    if layout == "sample":
+                        data = np.ascontiguousarray(data.T)
+                    chunk[layout] = _save_chunk(
+                        self.path / LAYOUTS[layout] / name,
+                        data,
+                        sample_major=layout == "sample",
+                        **options,
+                    )
+                chunk["metadata"] = _save_chunk(
+                    self.path / "metadata" / name, metadata[start:stop], **options
+                )
+                manifest["chunks"].append(chunk)
+                manifest["nb_traces"] += chunk["traces"]
+            _write_json(self.path / MANIFEST, manifest)
+
+    def extend(self, batches: Iterator[tuple[np.ndarray, np.ndarray]]):
+        """Append every (traces, metadata) batch"""
+        for traces, metadata in batches:
+            self.append(traces, metadata)
+
+
+def from_ascad(
+    path: Union[str, Path],
+    store: Union[str, Path, TraceStore],
+    group: str = "Profiling_traces",
+    **kwargs,
+) -> TraceStore:
+    """Append the :group: (Profiling_traces or Attack_traces) of an ASCAD
+    HDF5 file to :store:, created with the TraceStore.create :kwargs: if it
+    is a path"""
+    if not isinstance(store, TraceStore):
+        store = TraceStore.create(store, **kwargs)
+    chunk_size = store.manifest()["chunk_size"]
+    with h5py.File(path, "r") as file:
+        store.extend(
+            iter_chunks(file[group]["traces"], file[group]["metadata"], chunk_size)
+        )
+    return store
+
+
+def from_cw(
+    traces_path: Union[str, Path],
+    metadata_path: Union[str, Path],
+    store: Union[str, Path, TraceStore],
+    **kwargs,
+) -> TraceStore:
+    """Append the CW traces.npy and combined_*.npy files to :store:, created
+    with the TraceStore.create :kwargs: if it is a path"""
+    if not isinstance(store, TraceStore):
+        store = TraceStore.create(store, **kwargs)
+    chunk_size = store.manifest()["chunk_size"]
+    store.extend(
+        iter_chunks(
+            np.load(traces_path, mmap_mode="r"),
+            np.load(metadata_path, mmap_mode="r"),
+            chunk_size,
+        )
+    )
+    return store
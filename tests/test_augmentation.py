@@ -0,0 +1,27 @@
+import numpy as np
+
+from scadl.augmentation import Mixup
+from scadl.dataset import TraceDataset, TraceSequence
+
+
+def test_mixup_single_trace_is_mixed_with_itself():
+    x = np.arange(10, dtype=np.float32)[np.newaxis]
+    y = np.eye(4, dtype=np.float32)[[2]]
+    x_aug, y_aug = Mixup(seed=0).generate(x, y, ratio=3)
+    assert x_aug.shape == (4, 10) and y_aug.shape == (4, 4)
+    assert np.allclose(x_aug, x) and np.allclose(y_aug, y)
+
+
+def test_mixup_on_the_tail_batch():
+    rng = np.random.default_rng(0)
+    dataset = TraceDataset(rng.normal(size=(201, 10)), np.arange(201))
+    mixup = Mixup(seed=0)
+    sequence = TraceSequence(
+        dataset,
+        lambda metadata: np.eye(2, dtype=np.float32)[metadata % 2],
+        batch_size=100,
+        augmentation=lambda x, y: mixup.generate(x, y, ratio=1),
+    )
+    x, y = sequence[len(sequence) - 1]
+    assert x.shape == (2, 10) and y.shape == (2, 2)
+    assert np.allclose(x[1], x[0]) and np.allclose(y[1], y[0])
@@ -0,0 +1,24 @@
+import numpy as np
+
+from scadl.dataset import TraceDataset, iter_chunks
+
+
+def test_iter_chunks_of_an_array_and_of_a_dataset():
+    traces = np.arange(50, dtype=np.float32).reshape(25, 2)
+    metadata = np.arange(25)
+    for chunks in (
+        iter_chunks(traces, metadata, 10),
+        iter_chunks(TraceDataset(traces, metadata), chunk_size=10),
+    ):
+        chunks = list(chunks)
+        assert [len(x) for x, _ in chunks] == [10, 10, 5]
+        assert np.array_equal(np.concatenate([x for x, _ in chunks]), traces)
+        assert np.array_equal(np.concatenate([m for _, m in chunks]), metadata)
+
+
+def test_iter_chunks_merges_a_short_tail():
+    traces = np.zeros((25, 2))
+    chunks = list(iter_chunks(traces, chunk_size=10, minimum=6))
+    assert [len(x) for x, _ in chunks] == [10, 15]
+    assert all(m is None for _, m in chunks)
+    assert not list(iter_chunks(traces[:0]))
@@ -0,0 +1,34 @@
+import numpy as np
+
+from scadl.leakage_compiler import tabulated
+from scadl.rank import broadcasts, hypotheses, scalar_hypotheses
+from scadl.tools import sbox
+
+METADATA_DTYPE = np.dtype([("plaintext", np.uint8, (16,)), ("key", np.uint8, (16,))])
+
+
+def leakage_model(data, guess):
+    return sbox[data["plaintext"][2] ^ guess]
+
+
+def random_metadata(nb_traces: int = 1000) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    metadata = np.zeros(nb_traces, dtype=METADATA_DTYPE)
+    metadata["plaintext"] = rng.integers(0, 256, (nb_traces, 16))
+    return metadata
+
+
+def test_broadcasts():
+    record = random_metadata(1)[0]
+    guesses = np.arange(256)
+    assert broadcasts(leakage_model, record, guesses)
+    assert not broadcasts(lambda data, guess: int(guess) % 3, record, guesses)
+
+
+def test_tabulated_matches_the_scalar_model():
+    metadata = random_metadata()
+    guesses = np.arange(256)
+    expected = scalar_hypotheses(leakage_model, metadata, guesses)
+    model = tabulated(leakage_model)
+    assert np.array_equal(hypotheses(model, metadata, 256), expected)
+    assert model.tables
@@ -0,0 +1,28 @@
+import numpy as np
+
+from scadl.multi_task import compute_guessing_entropy
+from scadl.tools import sbox
+
+METADATA_DTYPE = np.dtype([("plaintext", np.uint8, (16,)), ("key", np.uint8, (16,))])
+
+
+def leakage_model(data, guess):
+    return sbox[data["plaintext"][0] ^ guess]
+
+
+def test_guessing_entropy_follows_the_global_seed():
+    rng = np.random.default_rng(0)
+    metadata = np.zeros(200, dtype=METADATA_DTYPE)
+    metadata["plaintext"] = rng.integers(0, 256, (200, 16))
+    predictions = rng.random((200, 256)).astype(np.float32)
+
+    def run():
+        return compute_guessing_entropy(
+            predictions, leakage_model, metadata, 256, 0, 10, 5
+        )[0]
+
+    np.random.seed(1)
+    first = run()
+    np.random.seed(1)
+    assert np.array_equal(run(), first)
+    assert not np.array_equal(run(), first)
@@ -0,0 +1,14 @@
+import numpy as np
+
+from scadl.pipeline import split_indices
+
+
+def test_split_indices_as_keras():
+    train, validation = split_indices(10, 0.25)
+    assert np.array_equal(train, np.arange(7))
+    assert np.array_equal(validation, np.arange(7, 10))
+
+
+def test_split_indices_without_validation():
+    train, validation = split_indices(10, 0.0)
+    assert np.array_equal(train, np.arange(10)) and validation is None
@@ -0,0 +1,52 @@
+import numpy as np
+
+from scadl.precision import check_predictions
+from scadl.tools import sbox
+
+METADATA_DTYPE = np.dtype([("plaintext", np.uint8, (16,)), ("key", np.uint8, (16,))])
+KEY = 0x2B
+
+
+def leakage_model(data, guess):
+    return sbox[data["plaintext"][0] ^ guess]
+
+
+def reference_predictions(nb_traces: int = 200):
+    rng = np.random.default_rng(0)
+    metadata = np.zeros(nb_traces, dtype=METADATA_DTYPE)
+    metadata["plaintext"] = rng.integers(0, 256, (nb_traces, 16))
+    metadata["key"] = KEY
+    predictions = rng.random((nb_traces, 256))
+    predictions[np.arange(nb_traces), sbox[metadata["plaintext"][:, 0] ^ KEY]] += 2
+    predictions /= predictions.sum(axis=1, keepdims=True)
+    return predictions.astype(np.float32), metadata
+
+
+def test_float16_predictions_pass():
+    reference, metadata = reference_predictions()
+    predictions = reference.astype(np.float16)
+    assert check_predictions(
+        reference, predictions, leakage_model, metadata, 256, KEY, 10
+    )
+
+
+def test_degraded_predictions_fail():
+    reference, metadata = reference_predictions()
+    # Rolling the classes keeps the probabilities but breaks the attack
+    predictions = np.roll(reference, 1, axis=1)
+    assert not check_predictions(
+        reference, predictions, leakage_model, metadata, 256, KEY, 10
+    )
+
+
+def test_low_agreement_fails():
+    reference, metadata = reference_predictions()
+    predictions = reference.copy()
+    rows = np.arange(0, len(reference), 20)
+    predictions[rows] = np.roll(reference[rows], 1, axis=1)
+    assert check_predictions(
+        reference, predictions, leakage_model, metadata, 256, KEY, 10, 255, 0.9
+    )
+    assert not check_predictions(
+        reference, predictions, leakage_model, metadata, 256, KEY, 10, 255, 0.99
+    )
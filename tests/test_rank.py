@@ -0,0 +1,124 @@
+import tracemalloc
+
+import numpy as np
+import pytest
+
+import scadl.rank
+from scadl.rank import guessing_entropy, key_rank, log_likelihood_matrix
+from scadl.tools import sbox
+
+METADATA_DTYPE = np.dtype([("plaintext", np.uint8, (16,)), ("key", np.uint8, (16,))])
+KEY = 0x2B
+
+
+def leakage_model(data, guess):
+    return sbox[data["plaintext"][0] ^ guess]
+
+
+def attack_data(nb_traces: int = 300, seed: int = 0):
+    """Predictions slightly favouring the sbox output of the correct key,
+    with some null probabilities"""
+    rng = np.random.default_rng(seed)
+    metadata = np.zeros(nb_traces, dtype=METADATA_DTYPE)
+    metadata["plaintext"] = rng.integers(0, 256, (nb_traces, 16))
+    metadata["key"] = KEY
+    predictions = rng.random((nb_traces, 256))
+    predictions[np.arange(nb_traces), sbox[metadata["plaintext"][:, 0] ^ KEY]] += 0.5
+    predictions[rng.random(predictions.shape) < 0.02] = 0
+    predictions /= predictions.sum(axis=1, keepdims=True)
+    return predictions.astype(np.float32), metadata
+
+
+def loop_rank(scores: np.ndarray, correct_key: int) -> int:
+    """Rank as the original loop of Match.match: position of the correct key
+    in the scores sorted in decreasing order"""
+    return np.where(sorted(scores)[::-1] == scores[correct_key])[0][0]
+
+
+def loop_key_rank(predictions, metadata, correct_key: int, step: int):
+    """Original per-trace and per-guess loop of Match.match"""
+    rank, x_rank = [], []
+    total = np.zeros(256)
+    for start in range(0, len(predictions), step):
+        for row in range(start, min(start + step, len(predictions))):
+            for guess in range(256):
+                probability = predictions[row, leakage_model(metadata[row], guess)]
+                if probability != 0:
+                    total[guess] += np.log2(probability)
+        rank.append(loop_rank(total, correct_key))
+        x_rank.append(start + step)
+    return np.array(rank), np.array(x_rank)
+
+
+def vectorized_model(metadata, guesses):
+    return sbox[metadata["plaintext"][:, 0, np.newaxis] ^ guesses]
+
+
+vectorized_model.vectorized = True
+
+
+@pytest.mark.parametrize("model", [leakage_model, vectorized_model])
+@pytest.mark.parametrize("key", [KEY, 0, 200])
+def test_key_rank_matches_the_loop(monkeypatch, model, key):
+    # Several blocks, the last one not a multiple of the step
+    monkeypatch.setattr(scadl.rank, "BLOCK_TRACES", 64)
+    predictions, metadata = attack_data()
+    rank, x_rank = key_rank(predictions, model, metadata, 256, key, 7)
+    expected_rank, expected_x_rank = loop_key_rank(predictions, metadata, key, 7)
+    assert np.array_equal(rank, expected_rank)
+    assert np.array_equal(x_rank, expected_x_rank)
+
+
+def loop_guessing_entropy(log_likelihood, num_attacks, nb_traces, step, seed):
+    """Mean rank and success rate of each attack ranked one by one, with the
+    random orderings of guessing_entropy"""
+    rng = np.random.default_rng(seed)
+    orders = np.argsort(rng.random((num_attacks, len(log_likelihood))), axis=1)
+    rank = []
+    for order in orders[:, :nb_traces]:
+        total = np.zeros(log_likelihood.shape[1])
+        attack = []
+        for start in range(0, nb_traces, step):
+            total += log_likelihood[order[start : start + step]].sum(axis=0)
+            attack.append(loop_rank(total, KEY))
+        rank.append(attack)
+    rank = np.array(rank)
+    return rank.mean(axis=0), np.mean(rank == 0, axis=0)
+
+
+@pytest.mark.parametrize("memory", [1 << 28, 1 << 16, 1 << 10])
+def test_guessing_entropy_matches_the_loop(memory):
+    predictions, metadata = attack_data()
+    log_likelihood = log_likelihood_matrix(predictions, leakage_model, metadata, 256)
+    result = guessing_entropy(
+        log_likelihood, KEY, 10, 20, nb_traces=95, memory=memory, seed=3
+    )
+    mean_rank, success_rate = loop_guessing_entropy(log_likelihood, 20, 95, 10, 3)
+    assert np.allclose(result.mean_rank, mean_rank)
+    assert np.allclose(result.success_rate, success_rate)
+    assert np.array_equal(result.x_rank, np.arange(1, 11) * 10)
+    lower, upper = result.mean_rank_ci
+    assert np.all(lower <= result.mean_rank) and np.all(result.mean_rank <= upper)
+
+
+def test_guessing_entropy_stays_within_the_memory_budget():
+    log_likelihood = np.zeros((1 << 18, 4))
+    memory = 1 << 22
+    tracemalloc.start()
+    try:
+        guessing_entropy(log_likelihood, 0, 1 << 14, 64, 1 << 10, memory, seed=0)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    # The random keys and the argsort of one attack fill the budget
+    assert peak < 2 * memory
+
+
+@pytest.mark.parametrize("sign, interval", [(1, (0.7225, 1.0)), (-1, (0.0, 0.2775))])
+def test_guessing_entropy_wilson_interval(sign, interval):
+    # The correct key is always (sign 1) or never (sign -1) ranked first:
+    # 10/10 and 0/10 successes give the Wilson intervals of the literature
+    log_likelihood = np.zeros((50, 4))
+    log_likelihood[:, 0] = sign
+    result = guessing_entropy(log_likelihood, 0, 5, 10, seed=0)
+    assert np.allclose(result.success_rate_ci[:, -1], interval, atol=1e-4)
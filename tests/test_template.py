@@ -0,0 +1,44 @@
+import numpy as np
+
+from scadl.rank import chunk_scores, ranks
+from scadl.template import Template
+from scadl.tools import SboxLeakage, hw, sbox
+
+METADATA_DTYPE = np.dtype([("plaintext", np.uint8, (16,)), ("key", np.uint8, (16,))])
+KEY = 0x2B
+
+
+def leaking_traces(nb_traces: int, noise: float, seed: int = 0):
+    """Traces of 10 samples, sample 3 leaking HW(sbox[p0 ^ k0])"""
+    rng = np.random.default_rng(seed)
+    metadata = np.zeros(nb_traces, dtype=METADATA_DTYPE)
+    metadata["plaintext"] = rng.integers(0, 256, (nb_traces, 16))
+    metadata["key"] = KEY
+    traces = rng.normal(0, noise, (nb_traces, 10))
+    traces[:, 3] += hw[sbox[metadata["plaintext"][:, 0] ^ KEY]]
+    return traces, metadata
+
+
+def template_attack(noise: float):
+    model = SboxLeakage(key_byte=0, output="hw")
+    traces, metadata = leaking_traces(2000, noise)
+    template = Template(model, num_classes=9).fit(traces, metadata)
+    return template, *leaking_traces(200, noise, seed=1)
+
+
+def test_match_ranks_the_log_likelihoods():
+    template, traces, metadata = template_attack(noise=2.0)
+    scores = chunk_scores(template.log_likelihood_matrix(traces, metadata, 256), 10)
+    for key in (KEY, 0, 17):
+        rank, x_rank = template.match(traces, metadata, 256, key, 10)
+        assert np.array_equal(rank, ranks(scores, key))
+    assert x_rank[-1] == 200
+
+
+def test_wrong_keys_are_not_ranked_first_without_noise():
+    template, traces, metadata = template_attack(noise=0.01)
+    rank, _ = template.match(traces, metadata, 256, KEY, 20)
+    assert rank[-1] == 0
+    for key in (0, 1, 2, 3, 4):
+        rank, _ = template.match(traces, metadata, 256, key, 20)
+        assert rank[-1] > 0
@@ -0,0 +1,40 @@
+import numpy as np
+
+from scadl.tools import SboxLeakage, gen_labels, sbox
+
+METADATA_DTYPE = np.dtype(
+    [
+        ("plaintext", np.uint8, (16,)),
+        ("key", np.uint8, (16,)),
+        ("masks", np.uint8, (16,)),
+    ]
+)
+
+
+def random_metadata(nb_traces: int = 100) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    metadata = np.zeros(nb_traces, dtype=METADATA_DTYPE)
+    for name in METADATA_DTYPE.names:
+        metadata[name] = rng.integers(0, 256, (nb_traces, 16))
+    return metadata
+
+
+def test_mask_byte_differs_from_key_byte():
+    metadata = random_metadata()
+    model = SboxLeakage(key_byte=2, mask_field="masks", mask_byte=0)
+    expected = (
+        sbox[metadata["plaintext"][:, 2] ^ metadata["key"][:, 2]]
+        ^ metadata["masks"][:, 0]
+    )
+    assert np.array_equal(model(metadata), expected)
+    assert np.array_equal(gen_labels(model, metadata, key_byte=2), expected)
+
+
+def test_mask_byte_follows_key_byte_by_default():
+    metadata = random_metadata()
+    model = SboxLeakage(mask_field="masks")
+    expected = (
+        sbox[metadata["plaintext"][:, 5] ^ metadata["key"][:, 5]]
+        ^ metadata["masks"][:, 5]
+    )
+    assert np.array_equal(gen_labels(model, metadata, key_byte=5), expected)
@@ -0,0 +1,44 @@
+import numpy as np
+import pytest
+
+from scadl.trace_store import TraceStore
+
+METADATA_DTYPE = np.dtype([("plaintext", np.uint8, (16,)), ("key", np.uint8, (16,))])
+
+
+@pytest.mark.parametrize("compression", [False, True])
+@pytest.mark.parametrize("layout", ["trace", "sample"])
+def test_chunked_array_indexing(tmp_path, compression, layout):
+    rng = np.random.default_rng(0)
+    traces = rng.normal(size=(250, 12)).astype(np.float32)
+    metadata = np.zeros(250, dtype=METADATA_DTYPE)
+    store = TraceStore.create(
+        tmp_path / "store",
+        chunk_size=100,
+        compression=compression,
+        layouts=("trace", "sample"),
+        block_size=16,
+    )
+    store.append(traces, metadata)
+    array = store.snapshot().traces(layout)
+
+    shuffled = rng.permutation(250)[:40]
+    mask = rng.random(250) < 0.3
+    for key in (
+        7,
+        -1,
+        np.int64(120),
+        slice(None),
+        slice(90, 230, 3),
+        slice(None, None, -7),
+        shuffled,
+        -shuffled - 1,
+        mask,
+        (shuffled, slice(2, 5)),
+        (slice(95, 105), np.array([0, 11])),
+    ):
+        assert np.array_equal(array[key], traces[key])
+    with pytest.raises(IndexError):
+        array[250]
+    with pytest.raises(IndexError):
+        array[np.array([3, -251])]
@@ -6,13 +6,9 @@ import numpy as np
 from keras.models import load_model
 
 from scadl.multi_label_profile import MatchMultiLabel
-from scadl.tools import sbox
+from scadl.tools import SboxLeakage
 
-TARGET_BYTE = 1  # or 0
-
-
-def leakage_model(data: np.ndarray, guess: int) -> int:
-    return sbox[guess ^ int(data["plaintext"][TARGET_BYTE])]
+TARGET_BYTES = (0, 1)
 
 
 if __name__ == "__main__":
@@ -26,9 +22,9 @@ if __name__ == "__main__":
     leakages = np.load(dataset_dir / "test/traces.npy")[0:SIZE]
     metadata = np.load(dataset_dir / "test/combined_test.npy")[0:SIZE]
 
-    # Select which key byte needs to be attacked
-    prob_range = (TARGET_BYTE * 256, 256 + TARGET_BYTE * 256)
-    correct_key = metadata["key"][0][TARGET_BYTE]
+    # The two key bytes are attacked with one inference, the outputs of
+    # byte i are the probabilities (i * 256, (i + 1) * 256)
+    correct_keys = [metadata["key"][0][i] for i in TARGET_BYTES]
 
     # poi have the same indexes like the profiling phase
     poi = np.concatenate((leakages[:, 1315:1325], leakages[:, 1490:1505]), axis=1)
@@ -36,18 +32,20 @@ if __name__ == "__main__":
     model = load_model("model.keras")
 
     # Matching process
-    test_engine = MatchMultiLabel(model=model, leakage_model=leakage_model)
-    rank, number_traces = test_engine.match(
+    test_engine = MatchMultiLabel(model=model)
+    ranks, number_traces = test_engine.match_all(
         x_test=poi,
         metadata=metadata,
         guess_range=256,
-        correct_key=correct_key,
+        correct_keys=correct_keys,
         step=1,
-        prob_range=prob_range,
+        leakage_models=SboxLeakage(key_byte=list(TARGET_BYTES)),
     )
 
-    # Plot the key rank
-    plt.plot(number_traces, rank, "black")
+    # Plot the key ranks
+    for i, rank in zip(TARGET_BYTES, ranks):
+        plt.plot(number_traces, rank, label=f"K[{i}]")
     plt.xlabel("Number of traces")
-    plt.ylabel("Average rank of K[1] ")
+    plt.ylabel("Rank")
+    plt.legend()
     plt.show()
@@ -45,7 +45,8 @@ if __name__ == "__main__":
     from keras.utils import to_categorical
     from sklearn.model_selection import train_test_split
 
-    from scadl.tools import sbox, standardize
+    from scadl.preprocessing import Scaler
+    from scadl.tools import SboxLeakage
 
     NB_BYTES = 16
 
@@ -66,28 +67,22 @@ if __name__ == "__main__":
         x, y, test_size=0.1
     )
 
-    x_train = standardize(x_train)
-    x_test = standardize(x_test)
+    # Same scaling for the training, validation and attack traces
+    scaler = Scaler("standardize").fit(x_train)
+    scaler.save("scaler.npz")
+    x_train = scaler.transform(x_train)
+    x_test = scaler.transform(x_test)
 
-    sbox_vectorized = np.vectorize(lambda x: sbox[x], otypes=[np.uint8])
-
-    def leakage_model_vectorized(metadata: np.ndarray) -> np.ndarray:
-        return sbox_vectorized(np.bitwise_xor(metadata["plaintext"], metadata["key"]))
+    # sbox[plaintext ^ key] of the 16 bytes at once
+    leakage_model = SboxLeakage()
+    labels_train = leakage_model(metadata_train)
+    labels_test = leakage_model(metadata_test)
 
     y_train = [
-        to_categorical(
-            leakage_model_vectorized(metadata_train[:, i]),
-            num_classes=256,
-        )
-        for i in range(NB_BYTES)
+        to_categorical(labels_train[:, i], num_classes=256) for i in range(NB_BYTES)
     ]
-
     y_test = [
-        to_categorical(
-            leakage_model_vectorized(metadata_test[:, i]),
-            num_classes=256,
-        )
-        for i in range(NB_BYTES)
+        to_categorical(labels_test[:, i], num_classes=256) for i in range(NB_BYTES)
     ]
 
     # Build the model
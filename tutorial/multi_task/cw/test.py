@@ -6,8 +6,10 @@ if __name__ == "__main__":
     import numpy as np
     from keras.models import load_model
 
+    from scadl.key_enumeration import log_likelihood_table, rank_estimation
     from scadl.multi_task import compute_guessing_entropy
-    from scadl.tools import sbox, standardize
+    from scadl.preprocessing import Scaler
+    from scadl.tools import SboxLeakage
 
     NB_BYTES = 16
 
@@ -24,7 +26,7 @@ if __name__ == "__main__":
 
     correct_key = metadata["key"][0]
 
-    traces = standardize(traces)
+    traces = Scaler.load("scaler.npz").transform(traces)
 
     model = load_model("model.keras")
 
@@ -33,7 +35,7 @@ if __name__ == "__main__":
     for i in range(NB_BYTES):
         guessing_entropy, number_traces = compute_guessing_entropy(
             predictions[i],
-            lambda data, guess: sbox[guess ^ int(data["plaintext"][i])],
+            SboxLeakage(key_byte=i),
             metadata,
             256,
             correct_key[i],
@@ -42,3 +44,13 @@ if __name__ == "__main__":
         )
         plt.plot(number_traces, guessing_entropy)
     plt.show()
+
+    # Remaining brute-force effort on the full 128-bit key
+    table = log_likelihood_table(
+        predictions, [SboxLeakage(key_byte=i) for i in range(NB_BYTES)], metadata
+    )
+    lower, estimate, upper = rank_estimation(table, correct_key)
+    print(
+        f"log2 full key rank: {np.log2(estimate + 1):.1f} "
+        f"[{np.log2(lower + 1):.1f}, {np.log2(upper + 1):.1f}]"
+    )
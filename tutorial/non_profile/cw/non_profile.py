@@ -1,4 +1,5 @@
 import sys
+from functools import partial
 from pathlib import Path
 
 import keras
@@ -7,7 +8,6 @@ import numpy as np
 import tensorflow as tf
 from keras.layers import Dense, Input
 from keras.models import Sequential
-from tqdm import tqdm
 
 from scadl.non_profile import NonProfile
 from scadl.tools import normalization, remove_avg, sbox
@@ -45,20 +45,17 @@ if __name__ == "__main__":
 
     # Non-profiling DL
     EPOCHS = 50
-    key_range = range(0, 256)
-    acc = np.zeros((len(key_range), EPOCHS))
     profile_engine = NonProfile(leakage_model=leakage_model)
-    for index, guess in enumerate(tqdm(key_range)):
-        acc[index] = profile_engine.train(
-            model=mlp_non_profiling(x_train.shape[1]),
-            x_train=x_train,
-            metadata=metadata,
-            guess=guess,
-            hist_acc="accuracy",
-            num_classes=2,
-            epochs=EPOCHS,
-            batch_size=1000,
-        )
+    acc, _ = profile_engine.attack_all(
+        model_builder=partial(mlp_non_profiling, x_train.shape[1]),
+        x_train=x_train,
+        metadata=metadata,
+        hist_acc="accuracy",
+        num_classes=2,
+        epochs=EPOCHS,
+        batch_size=1000,
+        mode="pool",
+    )
     guessed_key = np.argmax(np.max(acc, axis=1))
     print(f"guessed key = {guessed_key}")
     plt.plot(acc.T, "grey")
@@ -6,7 +6,8 @@ import matplotlib.pyplot as plt
 import numpy as np
 from keras.models import load_model
 
-from scadl.profile import Match
+from scadl.cache import PredictionCache
+from scadl.rank import guessing_entropy, log_likelihood_matrix
 from scadl.tools import normalization, remove_avg, sbox
 
 
@@ -35,32 +36,28 @@ if __name__ == "__main__":
     # Same preprocessing as for the training
     poi = normalization(remove_avg(poi), feature_range=(-1, 1))
 
-    # Load the model
+    # Load the model and predict the attack traces once, the predictions are
+    # kept on disk for the next runs with the same model and traces
     model = load_model("model.keras")
+    predictions = PredictionCache("predictions").predict(model, poi)
+
+    # Guessing entropy over TRIALS random draws of SIZE traces
     SIZE = 1000
     TRIALS = 20
-    test_engine = Match(model=model, leakage_model=leakage_model)
-
-    for i in range(TRIALS):
-        index = np.random.randint(len(leakages) - SIZE)
-        sample_poi = poi[index : index + SIZE]
-        sample_metadata = metadata[index : index + SIZE]
-        # Test the correct key rank
-        rank, number_traces = test_engine.match(
-            x_test=sample_poi,
-            metadata=sample_metadata,
-            guess_range=256,
-            correct_key=correct_key,
-            step=10,
-        )
-        if i == 0:
-            avg_rank = rank
-        else:
-            avg_rank += rank
-    avg_rank = avg_rank / TRIALS
+    log_likelihood = log_likelihood_matrix(
+        predictions, leakage_model, metadata, guess_range=256
+    )
+    result = guessing_entropy(
+        log_likelihood,
+        correct_key=correct_key,
+        step=10,
+        num_attacks=TRIALS,
+        nb_traces=SIZE,
+    )
 
     # Plot the result
-    plt.plot(number_traces, avg_rank, "black")
+    plt.plot(result.x_rank, result.mean_rank, "black")
+    plt.fill_between(result.x_rank, *result.mean_rank_ci, color="grey", alpha=0.3)
     plt.xlabel("Number of traces")
     plt.ylabel("Average rank of K[2]")
     plt.show()